@@ -1,3 +1,4 @@
+import os
 import uuid
 from datetime import datetime, timezone
 from langchain_core.runnables import RunnableLambda
@@ -6,23 +7,31 @@ from azure.cosmos import ContainerProxy as CosmosContainer # ★ 修正: Contain
 from azure.storage.blob import BlobServiceClient
 
 # servicesとutilsから必要な関数をインポート
-from services.azure_ai_services import get_ocr_text, translate_text_azure
+from services.azure_ai_services import get_ocr_blocks, translate_texts_azure
 from services.database_services import save_translation_to_cosmos, upload_image_to_blob
-from utils.image_utils import embed_text_on_image
+from services.translation_memory import TranslationMemory
+from utils.render_service import render_text_on_image
+from utils.text_chunking import chunk_ocr_blocks, DEFAULT_CHUNK_MAX_CHARS
+from utils.vector_utils import mean_vector, quantize_vector
 
 # このファイルでは、3つの論理エージェントの役割を一つのチェーンとして実装します。
-# 1. OCRエージェント (get_ocr_text)
-# 2. 翻訳エージェント (translate_text_azure)
-# 3. 埋込・保存エージェント (残りの処理)
+# 1. OCRエージェント (get_ocr_blocks)
+# 2. 翻訳エージェント (translate_texts_azure。OCRのブロック単位でチャンク化し、並列に翻訳)
+# 3. 埋込・保存エージェント (残りの処理。チャンクごとに埋め込みベクトルを作成)
+
+# 1チャンクあたりの最大文字数 (Translatorのリクエスト上限と埋め込みモデルのトークン上限に収まる大きさ)
+CHUNK_MAX_CHARS = int(os.getenv("TRANSLATION_CHUNK_MAX_CHARS", str(DEFAULT_CHUNK_MAX_CHARS)))
 
 def create_image_processing_chain(
     embeddings: AzureOpenAIEmbeddings,
     cosmos_container: CosmosContainer, # 型ヒントを修正後のものに
     blob_service_client: BlobServiceClient,
+    translation_memory: TranslationMemory = None,
 ):
     """
     画像処理の一連の流れを実行するLangChainのチェーンを作成する。
-    入力: {"image_bytes": bytes, "image_name": str}
+    translation_memory を指定すると、類似した原文の過去の訳文を再利用し、Translatorの呼び出しを省略する。
+    入力: {"image_bytes": bytes, "image_name": str, "tenant_id": str (省略可)}
     出力: 辞書。成功時は処理結果、失敗時はエラー情報を含む可能性。
     例: {"processed_image_bytes": bytes, "processed_image_url": str, "item_saved": dict}
     """
@@ -30,19 +39,44 @@ def create_image_processing_chain(
     # ステップ1: OCR処理 (入力: data_in -> 出力: data_with_ocr)
     def _ocr_step(data_in: dict) -> dict:
         print("Agent Step: OCR Processing...")
-        extracted_text = get_ocr_text(data_in["image_bytes"])
-        return {"extracted_text": extracted_text, **data_in}
+        ocr_blocks = get_ocr_blocks(data_in["image_bytes"])
+        extracted_text = " ".join(ocr_blocks)
+        return {"extracted_text": extracted_text, "ocr_blocks": ocr_blocks, **data_in}
     
     ocr_lambda = RunnableLambda(_ocr_step)
 
     # ステップ2: 翻訳処理 (入力: data_with_ocr -> 出力: data_with_translation)
     def _translate_step(data_with_ocr: dict) -> dict:
         print("Agent Step: Translation Processing...")
-        if data_with_ocr["extracted_text"]:
-            translated_text = translate_text_azure(data_with_ocr["extracted_text"], from_language_code="en", target_language_code="ja")
-        else:
-            translated_text = "" # 抽出テキストがなければ翻訳も空
-        return {"translated_text": translated_text, **data_with_ocr}
+        translated_chunks = []
+        translation_failed = False
+        # 翻訳メモリーに類似した原文があれば、その訳文を再利用する
+        memory_match = None
+        if translation_memory and data_with_ocr["extracted_text"]:
+            memory_match = translation_memory.lookup(data_with_ocr["extracted_text"], tenant_id=data_with_ocr.get("tenant_id"))
+        if memory_match:
+            print(f"Translation memory hit: reused '{memory_match['id']}' (similarity {memory_match['similarity']:.2f}).")
+            # 再利用した訳文はチャンクごとに改行で連結されているため、改行で分割して埋め込みのチャンクとする
+            translated_chunks = [chunk for chunk in memory_match["translatedText"].split("\n") if chunk]
+        elif data_with_ocr["extracted_text"]:
+            # OCRのブロック (段落) 単位でチャンク化し、上限内のリクエストに分けて並列に翻訳
+            source_chunks = chunk_ocr_blocks(data_with_ocr.get("ocr_blocks") or [data_with_ocr["extracted_text"]], CHUNK_MAX_CHARS)
+            translated_chunks = translate_texts_azure(source_chunks, from_language_code="en", target_language_code="ja")
+            if any(source and not translated for source, translated in zip(source_chunks, translated_chunks)):
+                # 一部のチャンクだけ訳文が欠けた状態で画像埋め込みや翻訳メモリーに使わないよう、翻訳全体を失敗として扱う
+                failed_count = sum(1 for source, translated in zip(source_chunks, translated_chunks) if source and not translated)
+                print(f"Translation failed for {failed_count} of {len(source_chunks)} chunks; treating the whole translation as failed.")
+                translated_chunks = []
+                translation_failed = True
+        # チャンクごとの訳文は改行で連結する (画像にはチャンクごとに行を分けて埋め込まれる)
+        translated_text = "\n".join(translated_chunks) # 抽出テキストがない場合や翻訳に失敗した場合は空
+        return {
+            "translated_text": translated_text,
+            "translated_chunks": translated_chunks,
+            "translation_memory_hit": bool(memory_match),
+            "translation_failed": translation_failed,
+            **data_with_ocr
+        }
         
     translation_lambda = RunnableLambda(_translate_step)
 
@@ -67,12 +101,13 @@ def create_image_processing_chain(
         # 画像に翻訳を埋め込み (翻訳テキストがない場合は抽出テキストを試みるか、何もしない)
         text_to_embed_on_image = translated_text if translated_text else extracted_text
         if text_to_embed_on_image:
-            processed_image_bytes = embed_text_on_image(original_image_bytes, text_to_embed_on_image)
+            # 描画はプロセスプールで実行し、セッションやチェーンのスレッドとCPUを奪い合わないようにする
+            processed_image_bytes = render_text_on_image(original_image_bytes, text_to_embed_on_image)
         else:
             processed_image_bytes = None # 埋め込むテキストがない場合
 
         # ファイル名とIDを生成
-        doc_id = str(uuid.uuid4()) # Cosmos DBのパーティションキーと一致させる
+        doc_id = str(uuid.uuid4()) # "id" パーティション戦略ではパーティションキーになる
         timestamp_utc = datetime.now(timezone.utc)
         
         # Blob名にはサニタイズが必要な場合がある (例: スペースや特殊文字)
@@ -90,24 +125,35 @@ def create_image_processing_chain(
         if processed_image_bytes and processed_image_blob_name:
             processed_image_url = upload_image_to_blob(blob_service_client, processed_image_bytes, processed_image_blob_name)
         
-        # 翻訳テキストをベクトル化 (翻訳テキストがある場合のみ)
+        # 翻訳テキストをチャンクごとにベクトル化 (翻訳テキストがある場合のみ)
+        # embed_documents は複数チャンクをまとめて1回のリクエストで埋め込む
         translation_embedding = None
-        if translated_text:
+        chunk_embeddings = None
+        translated_chunks = data_with_translation.get("translated_chunks") or ([translated_text] if translated_text else [])
+        if translated_chunks:
             try:
-                translation_embedding = embeddings.embed_query(translated_text)
+                chunk_vectors = embeddings.embed_documents(translated_chunks)
+                # ドキュメント全体の代表ベクトル (ベクトルインデックスで候補を絞り込むために使用)
+                translation_embedding = mean_vector(chunk_vectors)
+                if len(chunk_vectors) > 1:
+                    # 検索時に最も近いチャンクで順位付けするため、チャンクごとのベクトルをint8に量子化して保存 (JSONのfloat配列の約1/7〜1/16のサイズ)
+                    chunk_embeddings = [quantize_vector(vector) for vector in chunk_vectors]
             except Exception as e:
                 print(f"Error generating embedding for translated text: {e}")
                 # Embedding生成エラーは許容し、ベクトルなしで保存を試みることもできる
 
         # Cosmos DBに保存するアイテムを作成
         item_to_save = {
-            "id": doc_id, # パーティションキー
+            "id": doc_id, # パーティションキー ("id" 戦略の場合。createdMonth は保存時に補完)
+            "tenantId": data_with_translation.get("tenant_id"), # 階層パーティション戦略のキー (Noneの場合は保存時に既定値を補完)
             "originalImageName": original_image_name,
             "originalImageUrl": original_image_url,
             "processedImageUrl": processed_image_url, # Noneの可能性あり
             "originalText": extracted_text,
             "translatedText": translated_text,
             "embedding": translation_embedding, # Noneの可能性あり
+            "chunkEmbeddings": chunk_embeddings, # チャンクが1つの場合はNone
+            "translatedChunks": translated_chunks if chunk_embeddings else None,
             "originalLang": "en", # 固定
             "translatedLang": "ja", # 固定
             "createdAt": timestamp_utc.isoformat()
@@ -117,6 +163,10 @@ def create_image_processing_chain(
         try:
             save_translation_to_cosmos(cosmos_container, item_to_save)
             print(f"Item '{doc_id}' successfully saved to Cosmos DB.")
+            # Translatorで翻訳した結果は、次回以降の再利用のため翻訳メモリーに追加
+            if (translation_memory and translated_text and not data_with_translation.get("translation_memory_hit")
+                    and not data_with_translation.get("translation_failed")):
+                translation_memory.add(doc_id, extracted_text, translated_text, tenant_id=item_to_save["tenantId"])
         except Exception as e:
             print(f"Error saving item '{doc_id}' to Cosmos DB during agent step: {e}")
             # DB保存エラーの場合、部分的な成功として情報を返すか、全体をエラーとするか検討
@@ -131,7 +181,8 @@ def create_image_processing_chain(
             "processed_image_bytes": processed_image_bytes,
             "processed_image_url": processed_image_url,
             "item_saved": item_to_save,
-            "message": "処理が正常に完了しました。"
+            "message": ("翻訳に失敗したため、原文を画像に埋め込んで保存しました。"
+                        if data_with_translation.get("translation_failed") else "処理が正常に完了しました。")
         }
     
     embed_save_lambda = RunnableLambda(_embed_and_save_step)
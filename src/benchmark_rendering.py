@@ -0,0 +1,63 @@
+import argparse
+import glob
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.image_utils import embed_text_on_image
+from utils.render_service import RenderService
+
+# 画像へのテキスト埋め込みのスループット (renders/sec) を、ワーカープロセス数を変えて計測するベンチマーク
+# 既定では doc/sample_images の画像 (アプリで実際に扱うサイズの画像) を使用する。
+# 実行例 (src ディレクトリで実行):
+#   python benchmark_rendering.py --renders 64 --clients 8
+
+DEFAULT_IMAGE_GLOB = os.path.join(os.path.dirname(__file__), "..", "doc", "sample_images", "*.png")
+SAMPLE_TEXT = "\n".join([
+    "新鮮なバナナが1ポンドたったの2.99ドル！",
+    "今すぐ当店へお越しください。",
+    "営業時間: 午前9時から午後8時まで",
+])
+
+
+def _run(render, images: list, renders: int, clients: int) -> float:
+    """clients 個のスレッドから合計 renders 回描画し、1秒あたりの描画数を返す。"""
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        list(executor.map(lambda i: render(images[i % len(images)], SAMPLE_TEXT), range(renders)))
+    return renders / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="画像へのテキスト埋め込みのスループットを計測します。")
+    parser.add_argument("--images", default=DEFAULT_IMAGE_GLOB, help="ベンチマークに使用する画像のglobパターン")
+    parser.add_argument("--renders", type=int, default=64, help="1回の計測で描画する回数")
+    parser.add_argument("--clients", type=int, default=8, help="同時に描画を依頼するスレッド数 (同時利用ユーザー数の想定)")
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 1, help="計測するワーカープロセス数の上限")
+    args = parser.parse_args()
+
+    images = []
+    for path in sorted(glob.glob(args.images)):
+        with open(path, "rb") as f:
+            images.append(f.read())
+    if not images:
+        raise SystemExit(f"画像が見つかりません: {args.images}")
+    print(f"{len(images)} images, {args.renders} renders, {args.clients} concurrent clients, {os.cpu_count()} CPUs")
+
+    baseline = _run(embed_text_on_image, images, args.renders, args.clients)
+    print(f"{'in-thread':>12}: {baseline:7.2f} renders/sec")
+
+    worker_counts = sorted({1, 2, 4, 8, 16, args.max_workers} & set(range(1, args.max_workers + 1)))
+    for workers in worker_counts:
+        # 小さな画像も含めてプロセスプールで処理させるため、インライン描画の閾値は0にする
+        service = RenderService(max_workers=workers, inline_max_pixels=0)
+        try:
+            _run(service.render, images, workers, workers) # ワーカーの起動時間を計測から除く
+            throughput = _run(service.render, images, args.renders, args.clients)
+        finally:
+            service.shutdown()
+        print(f"{workers:>4} workers: {throughput:7.2f} renders/sec ({throughput / baseline:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,9 +9,17 @@ from langchain_openai import AzureOpenAIEmbeddings
 from services.database_services import (
     init_cosmos_db_client,
     get_cosmos_db_container,
-    search_histories_cosmos,
+    get_active_history_container_name,
+    iter_search_histories_pages,
     init_blob_service_client
 )
+from services.query_profiler import (
+    get_query_profile_summary,
+    get_recent_query_profiles,
+    reset_query_profiles
+)
+from services.partitioning import get_tenant_id_from_headers
+from services.translation_memory import TranslationMemory
 from agents.image_processing_agent import create_image_processing_chain
 
 # --- アプリケーション設定と初期化 ---
@@ -26,15 +34,33 @@ if "clients_initialized_successfully" not in st.session_state:
     st.session_state.clients_initialized_successfully = False
 if "search_history_results" not in st.session_state:
     st.session_state.search_history_results = []
+if "search_history_pager" not in st.session_state:
+    # 検索結果のページを順に返すジェネレーター。「さらに読み込む」で続きのページだけを取得する
+    st.session_state.search_history_pager = None
 if "last_processed_result" not in st.session_state:
     st.session_state.last_processed_result = None
 
 
 # --- Azureサービスクライアントの初期化 (Streamlitのキャッシュ機能を利用) ---
+@st.cache_resource # Cosmos DBクライアントはプロセス内で1つを使い回す
+def get_cosmos_db_client():
+    """Cosmos DBクライアントを初期化する (キャッシュ済みの場合はそれを返す)。"""
+    return init_cosmos_db_client()
+
+@st.cache_data(ttl=60) # 移行ツールによるコンテナー切り替えを1分以内に反映する
+def resolve_active_history_container_name():
+    """現在使用中の履歴コンテナー名を取得する。取得できない場合はNone (環境変数の値を使用)。"""
+    try:
+        return get_active_history_container_name(get_cosmos_db_client())
+    except Exception as e:
+        print(f"Error resolving active history container: {e}")
+        return None
+
 @st.cache_resource # リソースをキャッシュして再初期化を防ぐ
-def initialize_all_clients():
+def initialize_all_clients(history_container_name: str = None):
     """
     必要なAzureサービスクライアントとLangChainエージェントを初期化する。
+    履歴コンテナー名ごとにキャッシュされるため、コンテナーが切り替わると新しいコンテナーで再初期化される。
     Returns:
         dict: 初期化されたクライアントとチェーンを含む辞書。初期化失敗時はNone。
     """
@@ -51,15 +77,22 @@ def initialize_all_clients():
         )
         
         # Azure Cosmos DBクライアントとコンテナー
-        cosmos_db_client = init_cosmos_db_client()
-        cosmos_db_container = get_cosmos_db_container(cosmos_db_client)
+        cosmos_db_client = get_cosmos_db_client()
+        cosmos_db_container = get_cosmos_db_container(cosmos_db_client, history_container_name)
         
         # Azure Blob Storageクライアント
         blob_storage_client = init_blob_service_client()
         
+        # 翻訳メモリー (保存済みの翻訳から構築。読み込みに失敗しても翻訳処理は継続できる)
+        translation_memory = TranslationMemory()
+        try:
+            translation_memory.load_from_cosmos(cosmos_db_container)
+        except Exception as e:
+            print(f"Error loading translation memory: {e}")
+        
         # 画像処理チェーン (エージェント)
         image_processing_chain = create_image_processing_chain(
-            embeddings_service, cosmos_db_container, blob_storage_client
+            embeddings_service, cosmos_db_container, blob_storage_client, translation_memory
         )
         
         print("All clients and agent initialized successfully.")
@@ -68,6 +101,7 @@ def initialize_all_clients():
             "embeddings": embeddings_service,
             "cosmos_container": cosmos_db_container,
             "blob_client": blob_storage_client, # 将来的に使うかもしれないので保持
+            "translation_memory": translation_memory,
             "processing_chain": image_processing_chain
         }
     except Exception as e:
@@ -77,13 +111,21 @@ def initialize_all_clients():
         return None
 
 # アプリケーション開始時にクライアントを初期化
-initialized_clients = initialize_all_clients()
+initialized_clients = initialize_all_clients(resolve_active_history_container_name())
 
 if not st.session_state.clients_initialized_successfully:
     st.error(f"アプリケーションの起動に必要なサービスの初期化に失敗しました。詳細はログを確認してください。エラー: {st.session_state.error_message}")
     st.stop() # 初期化失敗時はアプリを停止
 
 
+def get_session_tenant_id() -> str:
+    """
+    このセッションのテナント/ユーザーキーを返す。App Serviceの認証が有効な場合はログインユーザーのIDになる。
+    (st.context はStreamlit 1.37以降。それより古い場合は環境変数の既定値を使用)
+    """
+    context = getattr(st, "context", None)
+    return get_tenant_id_from_headers(context.headers if context is not None else None)
+
 # --- コールバック関数を定義 ---
 def clear_search_results_on_change():
     """
@@ -91,8 +133,38 @@ def clear_search_results_on_change():
     表示されている検索結果をクリアするための関数。
     """
     st.session_state.search_history_results = []
+    st.session_state.search_history_pager = None
     # print("DEBUG: Search results cleared due to a change in search criteria.") # デバッグ用
 
+def fetch_next_search_page() -> int:
+    """
+    保持しているページジェネレーターから、結果を含む次のページを取得して検索結果に追加する。
+    Returns:
+        int: 追加された件数。これ以上ページがない場合は0。
+    """
+    pager = st.session_state.search_history_pager
+    if pager is None:
+        return 0
+    for page in pager:
+        if not page["continuationToken"]:
+            st.session_state.search_history_pager = None # 最終ページ
+        if page["items"]:
+            st.session_state.search_history_results.extend(page["items"])
+            return len(page["items"])
+        if st.session_state.search_history_pager is None:
+            return 0
+    st.session_state.search_history_pager = None
+    return 0
+
+def load_more_search_results():
+    """「さらに読み込む」ボタンのコールバック。前のページは再実行せず、続きのページだけを取得する。"""
+    try:
+        if fetch_next_search_page() == 0:
+            st.session_state.search_history_pager = None
+    except Exception as e:
+        st.session_state.search_history_pager = None
+        st.session_state.search_error_message = f"履歴検索中にエラーが発生しました: {e}"
+
 # --- Streamlit UIレイアウト ---
 st.title("🌐 TransEmbPic - 翻訳埋込エージェント")
 st.caption("画像から外国語を抽出し、母国語に翻訳・埋め込み・保存するWebアプリ (Azure AI活用)")
@@ -111,7 +183,11 @@ with main_processing_col2:
         if st.button("🤖 翻訳・埋込・保存を実行", type="primary"):
             with st.spinner("AIエージェントが画像処理を実行中です..."):
                 try:
-                    chain_input_data = {"image_bytes": uploaded_image_file.getvalue(), "image_name": uploaded_image_file.name}
+                    chain_input_data = {
+                        "image_bytes": uploaded_image_file.getvalue(),
+                        "image_name": uploaded_image_file.name,
+                        "tenant_id": get_session_tenant_id() # パーティションキー (tenantId) として保存
+                    }
                     processing_result = initialized_clients["processing_chain"].invoke(chain_input_data)
                     st.session_state.last_processed_result = processing_result 
                     if processing_result.get("error"): st.error(processing_result['error'])
@@ -154,6 +230,19 @@ search_mode = st.radio(
     on_change=clear_search_results_on_change # モード変更時にコールバックを呼び出す
 )
 
+# 絞り込み条件 (Cosmos DBのWHERE句でサーバー側に評価させる)
+with st.expander("絞り込み条件"):
+    filter_col1, filter_col2, filter_col3 = st.columns(3)
+    with filter_col1:
+        filter_created_from = st.date_input("翻訳日 (開始)", value=None, key="filter_created_from_key", on_change=clear_search_results_on_change)
+        filter_created_to = st.date_input("翻訳日 (終了)", value=None, key="filter_created_to_key", on_change=clear_search_results_on_change)
+    with filter_col2:
+        filter_original_lang = st.text_input("原文の言語コード (例: en)", key="filter_original_lang_key", on_change=clear_search_results_on_change)
+        filter_translated_lang = st.text_input("訳文の言語コード (例: ja)", key="filter_translated_lang_key", on_change=clear_search_results_on_change)
+    with filter_col3:
+        filter_image_name = st.text_input("元ファイル名に含まれる文字列", key="filter_image_name_key", on_change=clear_search_results_on_change)
+        search_page_size = st.selectbox("1ページの表示件数", (5, 10, 20), key="search_page_size_key", on_change=clear_search_results_on_change)
+
 # --- セッションステートに検索モードごとのフラグを追加 ---
 if "search_executed_modes" not in st.session_state:
     st.session_state.search_executed_modes = set()
@@ -175,20 +264,31 @@ if st.button("🔍 履歴を検索"):
         #with st.spinner(f"{search_mode}を実行中..."):
         with st.spinner(f"{current_mode_display}を実行中..."):
             try:
-                # search_histories_cosmos関数を呼び出して結果を取得
-                st.session_state.search_history_results = search_histories_cosmos(
+                # ページ単位の検索ジェネレーターを保持し、最初のページだけを取得する
+                st.session_state.search_history_results = []
+                st.session_state.search_history_pager = iter_search_histories_pages(
                     initialized_clients["cosmos_container"],
                     initialized_clients["embeddings"],
                     search_query_text,
                     search_mode=selected_mode_internal,
-                    top_k=5 
+                    page_size=search_page_size,
+                    filters={
+                        "created_from": filter_created_from,
+                        "created_to": filter_created_to,
+                        "original_lang": filter_original_lang.strip(),
+                        "translated_lang": filter_translated_lang.strip(),
+                        "image_name": filter_image_name.strip(),
+                        "tenant_id": get_session_tenant_id(), # 階層パーティション戦略ではこのユーザーと既定テナント (移行前の履歴) のパーティションを検索
+                    }
                 )
+                fetch_next_search_page()
                 st.session_state.search_executed_modes.add(selected_mode_internal)  # 検索実行フラグを記録
                 if not st.session_state.search_history_results:
                     st.info("検索キーワードに一致する翻訳履歴は見つかりませんでした。")
             except Exception as e:
                 st.error(f"履歴検索中にエラーが発生しました: {e}")
                 st.session_state.search_history_results = []
+                st.session_state.search_history_pager = None
     else:
         st.warning("検索キーワードを入力してください。")
         st.session_state.search_history_results = []
@@ -241,3 +341,31 @@ if st.session_state.get("search_history_results"):
             with res_col2:
                 if db_item.get('processedImageUrl'): st.image(db_item['processedImageUrl'], "加工済み画像", use_container_width=True)
                 else: st.write("この履歴には加工済み画像はありません。")
+
+
+    # 続きのページがある場合のみ「さらに読み込む」を表示
+    if st.session_state.get("search_error_message"):
+        st.error(st.session_state.pop("search_error_message"))
+    if st.session_state.search_history_pager is not None:
+        st.button("⬇️ さらに読み込む", on_click=load_more_search_results)
+
+# --- デバッグパネル: Cosmos DBクエリのRU/レイテンシー集計 ---
+# サイドバーのチェックボックスで表示を切り替える (既定は非表示)
+with st.sidebar:
+    if st.checkbox("🛠️ デバッグ: Cosmos DBクエリプロファイル", key="show_query_profiler_key"):
+        st.caption("クエリ形状・検索モード・top_kごとのRU消費量とレイテンシー (アプリ起動後の累計)")
+        profile_summary = get_query_profile_summary()
+        if profile_summary:
+            st.dataframe(profile_summary, use_container_width=True)
+            with st.expander("直近のクエリ"):
+                st.dataframe(
+                    [{k: v for k, v in profile.items() if k not in ("indexMetrics", "indexUtilizationWeightedSum", "indexUtilizationWeight")} for profile in get_recent_query_profiles()],
+                    use_container_width=True
+                )
+        else:
+            st.info("まだ計測されたクエリはありません。")
+        st.caption("翻訳メモリー (過去の訳文の再利用状況)")
+        st.json(initialized_clients["translation_memory"].stats())
+        if st.button("集計をリセット", key="reset_query_profiler_key"):
+            reset_query_profiles()
+            st.rerun()
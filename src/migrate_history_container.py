@@ -0,0 +1,37 @@
+import argparse
+from dotenv import load_dotenv
+
+from services.database_services import init_cosmos_db_client
+from services.container_migration import migrate_history_container
+from services.partitioning import PARTITION_STRATEGIES
+
+# 履歴コンテナーを別のパーティションキー戦略のコンテナーへ無停止で移行するツール
+# 実行例 (src ディレクトリで実行):
+#   python migrate_history_container.py --target ImageTranslationsByTenant --strategy hierarchical --checkpoint migration.json
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="履歴コンテナーを新しいパーティションキー戦略のコンテナーへ移行します。")
+    parser.add_argument("--target", required=True, help="移行先のコンテナー名")
+    parser.add_argument("--strategy", required=True, choices=list(PARTITION_STRATEGIES), help="移行先のパーティションキー戦略")
+    parser.add_argument("--source", default=None, help="移行元のコンテナー名 (省略時は現在使用中の履歴コンテナー)")
+    parser.add_argument("--checkpoint", default=None, help="継続トークンを保存するファイル (中断した移行の再開用)")
+    parser.add_argument("--drain-seconds", type=int, default=120, help="切り替え後に旧コンテナーの書き込みをコピーし続ける秒数")
+    parser.add_argument("--no-cutover", action="store_true", help="コピーと件数検証のみ行い、切り替えない")
+    args = parser.parse_args()
+
+    result = migrate_history_container(
+        init_cosmos_db_client(),
+        target_container_name=args.target,
+        partition_strategy=args.strategy,
+        source_container_name=args.source,
+        checkpoint_path=args.checkpoint,
+        drain_seconds=args.drain_seconds,
+        cutover=not args.no_cutover
+    )
+    print(result)
+
+
+if __name__ == "__main__":
+    main()
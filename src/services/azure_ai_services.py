@@ -1,10 +1,19 @@
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from azure.core.credentials import AzureKeyCredential
 from azure.core.exceptions import HttpResponseError # Azure SDKのHTTPエラーをインポート
 from azure.ai.vision.imageanalysis import ImageAnalysisClient
 from azure.ai.vision.imageanalysis.models import VisualFeatures
 from azure.ai.translation.text import TextTranslationClient
 
+# Translatorの1リクエストあたりの上限 (要素数1000、合計50,000文字) より小さく分割し、複数リクエストを並列に送る
+TRANSLATOR_MAX_ELEMENTS_PER_REQUEST = 1000
+TRANSLATOR_MAX_CHARS_PER_REQUEST = int(os.getenv("AZURE_TRANSLATOR_MAX_CHARS_PER_REQUEST", "10000"))
+TRANSLATOR_MAX_WORKERS = int(os.getenv("AZURE_TRANSLATOR_MAX_WORKERS", "4"))
+# 翻訳できなかったチャンクを再送するまでの待機秒数 (一時的なエラーやスロットリング対策、再送は1回のみ)
+TRANSLATOR_RETRY_DELAY_SECONDS = float(os.getenv("AZURE_TRANSLATOR_RETRY_DELAY_SECONDS", "1"))
+
 def get_ocr_text(image_bytes: bytes) -> str:
     """
     Azure AI Visionを使用して画像からテキストを抽出する。
@@ -15,6 +24,19 @@ def get_ocr_text(image_bytes: bytes) -> str:
     Returns:
         str: 抽出されたテキスト。抽出できなかった場合は空文字。
     """
+    return " ".join(get_ocr_blocks(image_bytes))
+
+
+def get_ocr_blocks(image_bytes: bytes) -> list:
+    """
+    Azure AI Visionを使用して画像からテキストをブロック (段落) 単位で抽出する。
+
+    Args:
+        image_bytes (bytes): 画像のバイトデータ。
+
+    Returns:
+        list: ブロックごとのテキスト (ブロック内の行は空白で連結)。抽出できなかった場合は空リスト。
+    """
     try:
         # 環境変数が正しく設定されているか確認
         endpoint = os.getenv("AZURE_COMPUTER_VISION_ENDPOINT")
@@ -33,18 +55,100 @@ def get_ocr_text(image_bytes: bytes) -> str:
             visual_features=[VisualFeatures.READ] # READ機能でテキスト抽出
         )
         
-        extracted_text = ""
+        extracted_blocks = []
         if result.read is not None and result.read.blocks:
-            extracted_text = " ".join([line.text for block in result.read.blocks for line in block.lines])
+            extracted_blocks = [" ".join(line.text for line in block.lines) for block in result.read.blocks]
         
-        print(f"OCR Result: '{extracted_text}'") # デバッグ用に抽出結果をログ出力
-        return extracted_text
+        print(f"OCR Result: {len(extracted_blocks)} blocks, '{' '.join(extracted_blocks)}'") # デバッグ用に抽出結果をログ出力
+        return extracted_blocks
             
     except Exception as e:
         print(f"Error during OCR: {e}")
-        # エラー発生時は空文字を返すか、エラーを再raiseするかは要件による
-        # ここではエラーをログに出力し、空文字を返す
-        return ""
+        # エラー発生時は空リストを返すか、エラーを再raiseするかは要件による
+        # ここではエラーをログに出力し、空リストを返す
+        return []
+
+
+def _create_translator_client() -> TextTranslationClient:
+    """環境変数からAzure Translatorのクライアントを作成する。"""
+    translator_key = os.getenv("AZURE_TRANSLATOR_KEY")
+    translator_endpoint = os.getenv("AZURE_TRANSLATOR_ENDPOINT")
+    if not translator_key or not translator_endpoint:
+        raise ValueError("Azure Translatorのキーまたはエンドポイントの環境変数が設定されていません。")
+    return TextTranslationClient(endpoint=translator_endpoint, credential=AzureKeyCredential(translator_key))
+
+
+def _batch_for_translator(texts: list) -> list:
+    """テキストのインデックスを、Translatorの1リクエストの上限に収まるバッチに分ける。"""
+    batches, current, current_chars = [], [], 0
+    for index, text in enumerate(texts):
+        if current and (len(current) >= TRANSLATOR_MAX_ELEMENTS_PER_REQUEST or current_chars + len(text) > TRANSLATOR_MAX_CHARS_PER_REQUEST):
+            batches.append(current)
+            current, current_chars = [], 0
+        current.append(index)
+        current_chars += len(text)
+    if current:
+        batches.append(current)
+    return batches
+
+
+def translate_texts_azure(texts: list, from_language_code: str = "en", target_language_code: str = "ja") -> list:
+    """
+    Azure AI Translatorを使用して複数のテキスト (チャンク) を翻訳する。
+    リクエスト上限に収まるようにバッチに分け、バッチを並列に送信する。
+
+    Args:
+        texts (list): 翻訳するテキストのリスト。
+        from_language_code (str): 元の言語コード (例: "en")。
+        target_language_code (str): 翻訳先の言語コード (例: "ja")。
+
+    Returns:
+        list: 入力と同じ順序の翻訳結果リスト。1回再送しても翻訳できなかった要素は空文字。
+    """
+    translated_texts = [""] * len(texts)
+    if not any(texts):
+        print("Translation skipped: input texts are empty.")
+        return translated_texts
+
+    try:
+        text_translator_client = _create_translator_client()
+    except Exception as e:
+        print(f"Error creating translator client: {e}")
+        return translated_texts
+
+    def _translate_batch(batch: list):
+        try:
+            response = text_translator_client.translate(
+                body=[{"text": texts[index]} for index in batch],
+                to_language=[target_language_code],
+                from_language=from_language_code
+            )
+            for index, translation_entry in zip(batch, response or []):
+                if getattr(translation_entry, 'translations', None):
+                    translated_texts[index] = getattr(translation_entry.translations[0], 'text', "")
+        except HttpResponseError as e: # Azure SDKのHTTPエラーを具体的にキャッチ
+            print(f"Azure HTTP Error during batch translation: {e.status_code} - {e.reason}")
+        except Exception as e:
+            print(f"Generic error during batch translation: {e}")
+
+    def _translate_indices(indices: list):
+        batches = _batch_for_translator([texts[index] for index in indices])
+        batches = [[indices[position] for position in batch] for batch in batches] # 元のインデックスに戻す
+        print(f"Translating {len(indices)} chunks in {len(batches)} requests from '{from_language_code}' to '{target_language_code}'...")
+        if len(batches) == 1:
+            _translate_batch(batches[0])
+        else:
+            with ThreadPoolExecutor(max_workers=min(TRANSLATOR_MAX_WORKERS, len(batches))) as executor:
+                list(executor.map(_translate_batch, batches))
+
+    _translate_indices(list(range(len(texts))))
+    # 空でない原文なのに訳文が空のチャンク (失敗したバッチ) は、少し待ってから1回だけ再送する
+    failed_indices = [index for index, text in enumerate(texts) if text and not translated_texts[index]]
+    if failed_indices:
+        print(f"Retrying {len(failed_indices)} untranslated chunks in {TRANSLATOR_RETRY_DELAY_SECONDS} seconds...")
+        time.sleep(TRANSLATOR_RETRY_DELAY_SECONDS)
+        _translate_indices(failed_indices)
+    return translated_texts
 
 
 def translate_text_azure(text: str, from_language_code: str = "en", target_language_code: str = "ja") -> str:
@@ -64,21 +168,9 @@ def translate_text_azure(text: str, from_language_code: str = "en", target_langu
         return ""
         
     try:
-        # 環境変数が正しく設定されているか確認
-        translator_key = os.getenv("AZURE_TRANSLATOR_KEY")
-        # translator_region = os.getenv("AZURE_TRANSLATOR_REGION") # TextTranslationClientでは通常リージョンはエンドポイントに含まれるか、キーの認証情報で解決される
-        translator_endpoint = os.getenv("AZURE_TRANSLATOR_ENDPOINT")
-
-        if not translator_key or not translator_endpoint:
-            raise ValueError("Azure Translatorのキーまたはエンドポイントの環境変数が設定されていません。")
-
-        # TextTranslationClient の初期化には AzureKeyCredential を使用
-        credential = AzureKeyCredential(translator_key)
-        #credential = TranslatorCredential(translator_key, translator_region)
-        text_translator_client = TextTranslationClient(
-            endpoint=translator_endpoint,
-            credential=credential
-        )
+        # 環境変数が正しく設定されているか確認し、AzureKeyCredential でクライアントを初期化
+        # (TextTranslationClientでは通常リージョンはエンドポイントに含まれるか、キーの認証情報で解決される)
+        text_translator_client = _create_translator_client()
         
         print(f"Attempting translation from '{from_language_code}' to '{target_language_code}' for text: '{text[:100]}...'")
 
@@ -0,0 +1,209 @@
+import json
+import os
+import time
+from azure.cosmos import CosmosClient
+
+from services.database_services import (
+    build_history_indexing_policy,
+    get_cosmos_db_database,
+    get_active_history_container_name,
+    set_active_history_container_name
+)
+from services.partitioning import add_partition_fields, build_partition_key
+
+# このファイルでは、履歴コンテナーを別のパーティションキー戦略のコンテナーへオンライン移行します。
+# 1. 新しいパーティションキー定義でコンテナーを作成 (インデックス/ベクトル/全文検索ポリシーは移行元を引き継ぐ)
+# 2. 変更フィードを先頭から読み、全ドキュメントを新コンテナーへコピー
+# 3. 追いつくまで変更フィードの差分コピーを繰り返す
+# 4. 件数を検証し、一致したらメタデータのポインターを切り替える (アプリは1分以内に新コンテナーを使い始める)
+# 5. 切り替え前のコンテナーを参照しているアプリインスタンスの書き込みを、猶予時間のあいだ引き続きコピーする
+# ※ 変更フィード (最新バージョンモード) には削除が含まれないため、移行中の削除は新コンテナーに反映されません。
+# ※ tenantId を持たないドキュメントは既定のテナントキー (AZURE_COSMOS_DB_TENANT_ID) で移行されます。
+#   hierarchical 戦略の検索は既定で既定テナントも含めるため (AZURE_COSMOS_DB_SEARCH_DEFAULT_TENANT)、切り替え後も過去の履歴を参照できます。
+
+# Cosmos DBが付与するシステムプロパティ (コピー時に除去する)
+SYSTEM_PROPERTIES = ("_rid", "_self", "_etag", "_attachments", "_ts", "_lsn")
+
+
+def create_target_container(database, source_container, target_container_name: str, partition_strategy: str, offer_throughput: int = 400):
+    """
+    移行先のコンテナーを作成する。移行元のインデックス・ベクトル・全文検索ポリシーを引き継ぐ。
+    インデックスポリシーには、範囲インデックスが不要なフィールド (HISTORY_INDEX_EXCLUDED_PATHS) の除外パスを追加する。
+    """
+    source_properties = source_container.read()
+    policies = {"indexing_policy": build_history_indexing_policy(source_properties.get("indexingPolicy"))}
+    if source_properties.get("vectorEmbeddingPolicy"):
+        policies["vector_embedding_policy"] = source_properties["vectorEmbeddingPolicy"]
+    if source_properties.get("fullTextPolicy"):
+        policies["full_text_policy"] = source_properties["fullTextPolicy"]
+
+    target_container = database.create_container_if_not_exists(
+        id=target_container_name,
+        partition_key=build_partition_key(partition_strategy),
+        offer_throughput=offer_throughput,
+        **policies
+    )
+    print(f"Target container '{target_container_name}' is ready (partition strategy: '{partition_strategy}').")
+    return target_container
+
+
+def _to_target_document(document: dict) -> dict:
+    """移行元のドキュメントからシステムプロパティを除き、パーティションキー用フィールドを補完する。"""
+    target_document = {key: value for key, value in document.items() if key not in SYSTEM_PROPERTIES}
+    return add_partition_fields(target_document)
+
+
+def copy_changes(source_container, target_container, continuation: str = None, on_page=None) -> tuple:
+    """
+    変更フィードを読み、変更されたドキュメントを移行先へupsertする。
+
+    Args:
+        source_container: 移行元のコンテナー。
+        target_container: 移行先のコンテナー。
+        continuation (str): 前回の続きから読む場合の継続トークン。Noneの場合は先頭から読む。
+        on_page: ページをコピーするたびに (このパスでコピーした件数, 継続トークン) を受け取る関数 (チェックポイントの保存用)。
+
+    Returns:
+        tuple: (コピーした件数, 次回用の継続トークン)
+    """
+    # 継続トークンはページャーの continuation_token を使う。全物理パーティションの位置をまとめたトークンのため、
+    # 複数の物理パーティションを持つコンテナーでも正しい位置から再開できる
+    # (レスポンスヘッダーの etag は物理パーティションごとの値で、再開には使えない)。
+    change_feed_kwargs = {} if continuation else {"is_start_from_beginning": True}
+    pager = source_container.query_items_change_feed(**change_feed_kwargs).by_page(continuation)
+    copied = 0
+    for page in pager:
+        for document in page:
+            target_container.upsert_item(body=_to_target_document(document))
+            copied += 1
+            if copied % 500 == 0:
+                print(f"  copied {copied} documents...")
+        continuation = pager.continuation_token or continuation
+        if on_page:
+            on_page(copied, continuation)
+    return copied, continuation
+
+
+def count_items(container) -> int:
+    """コンテナー内のドキュメント件数を返す。"""
+    return next(iter(container.query_items(
+        query="SELECT VALUE COUNT(1) FROM c",
+        enable_cross_partition_query=True
+    )), 0)
+
+
+def _save_checkpoint(checkpoint_path: str, state: dict):
+    if checkpoint_path:
+        with open(checkpoint_path, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False, indent=2)
+
+
+def _load_checkpoint(checkpoint_path: str) -> dict:
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        with open(checkpoint_path, encoding="utf-8") as f:
+            return json.load(f)
+    return {}
+
+
+def migrate_history_container(
+    client: CosmosClient,
+    target_container_name: str,
+    partition_strategy: str,
+    source_container_name: str = None,
+    checkpoint_path: str = None,
+    max_catchup_passes: int = 10,
+    drain_seconds: int = 120,
+    poll_interval_seconds: int = 5,
+    cutover: bool = True
+) -> dict:
+    """
+    履歴コンテナーを新しいパーティションキー戦略のコンテナーへ無停止で移行する。
+
+    Args:
+        client: Cosmos DBクライアント。
+        target_container_name (str): 移行先のコンテナー名。
+        partition_strategy (str): 移行先のパーティションキー戦略 ('id', 'time_bucket', 'hierarchical')。
+        source_container_name (str): 移行元のコンテナー名。省略時は現在使用中の履歴コンテナー。
+        checkpoint_path (str): 継続トークンを保存するファイル。中断した移行を再開する場合に使用。
+        max_catchup_passes (int): 差分コピーを繰り返す最大回数。
+        drain_seconds (int): 切り替え後に旧コンテナーへの書き込みを引き続きコピーする時間 (秒)。
+        poll_interval_seconds (int): 差分コピー間の待機時間 (秒)。
+        cutover (bool): Falseの場合はコピーと検証のみ行い、切り替えない。
+
+    Returns:
+        dict: 移行結果 (コピー件数、件数検証結果、切り替えの有無)。
+    """
+    database = get_cosmos_db_database(client)
+    source_container_name = source_container_name or get_active_history_container_name(client)
+    if source_container_name == target_container_name:
+        raise ValueError("移行元と移行先のコンテナー名が同じです。")
+
+    source_container = database.get_container_client(source_container_name)
+    target_container = create_target_container(database, source_container, target_container_name, partition_strategy)
+
+    checkpoint = _load_checkpoint(checkpoint_path)
+    continuation = checkpoint.get("continuation") if checkpoint.get("target") == target_container_name else None
+    total_copied = checkpoint.get("copied", 0) if continuation else 0
+
+    def _save_progress(copied: int, page_continuation: str):
+        # ページごとに保存し、中断してもコピー済みのページから再開できるようにする
+        _save_checkpoint(checkpoint_path, {
+            "source": source_container_name,
+            "target": target_container_name,
+            "continuation": page_continuation,
+            "copied": total_copied + copied,
+        })
+
+    def _copy_pass(label: str) -> int:
+        nonlocal continuation, total_copied
+        copied, continuation = copy_changes(source_container, target_container, continuation, on_page=_save_progress)
+        total_copied += copied
+        print(f"[{label}] copied {copied} documents (total {total_copied}).")
+        return copied
+
+    # 全件コピー (再開時は前回の続きから) と差分コピー
+    _copy_pass("resume" if continuation else "initial copy")
+    for catchup_pass in range(max_catchup_passes):
+        time.sleep(poll_interval_seconds)
+        if _copy_pass(f"catch-up {catchup_pass + 1}") == 0:
+            break
+
+    # 件数の検証。検証中の書き込みで差が出た場合は差分コピーして再検証する
+    source_count, target_count = count_items(source_container), count_items(target_container)
+    for _ in range(3):
+        if source_count == target_count:
+            break
+        print(f"Count mismatch (source={source_count}, target={target_count}). Copying remaining changes...")
+        _copy_pass("verify")
+        source_count, target_count = count_items(source_container), count_items(target_container)
+
+    result = {
+        "source": source_container_name,
+        "target": target_container_name,
+        "copied": total_copied,
+        "sourceCount": source_count,
+        "targetCount": target_count,
+        "countsMatch": source_count == target_count,
+        "cutover": False,
+    }
+    print(f"Verification: source={source_count}, target={target_count}")
+
+    if not result["countsMatch"]:
+        print("Counts do not match. Cutover skipped.")
+        return result
+    if not cutover:
+        print("Cutover skipped (copy and verify only).")
+        return result
+
+    # 切り替え。アプリは使用中のコンテナー名を定期的に確認しているため、再起動なしで新コンテナーへ移る
+    set_active_history_container_name(client, target_container_name)
+    result["cutover"] = True
+
+    # 切り替えを検知する前のアプリインスタンスが旧コンテナーに書いた分をコピーし続ける
+    drain_deadline = time.monotonic() + drain_seconds
+    while time.monotonic() < drain_deadline:
+        time.sleep(poll_interval_seconds)
+        _copy_pass("drain")
+    result["copied"] = total_copied
+    print(f"Migration from '{source_container_name}' to '{target_container_name}' completed.")
+    return result
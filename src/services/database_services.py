@@ -1,7 +1,19 @@
 import os
+import json
+from datetime import date, datetime, time, timedelta, timezone
 from azure.cosmos import CosmosClient, PartitionKey, exceptions as cosmos_exceptions
 from azure.storage.blob import BlobServiceClient
 from langchain_openai import AzureOpenAIEmbeddings # AzureOpenAIEmbeddingsのインポートを確認
+from services.query_profiler import profile_cosmos_query, profile_cosmos_upsert, iter_profiled_query_pages
+from utils.vector_utils import cosine_similarity, dequantize_vector
+from services.partitioning import (
+    add_partition_fields,
+    build_partition_key,
+    build_tenant_filter_clause,
+    get_configured_partition_strategy,
+    get_container_partition_strategy,
+    resolve_query_scope
+)
 
 # --- Cosmos DB Functions ---
 
@@ -13,19 +25,94 @@ def init_cosmos_db_client() -> CosmosClient:
         raise ValueError("Azure Cosmos DBの環境変数が設定されていません。")
     return CosmosClient(url=endpoint, credential=key)
 
-def get_cosmos_db_container(client: CosmosClient):
-    """Cosmos DBのデータベースとコンテナーを取得または作成する。"""
+# 移行ツールが切り替え先のコンテナー名を記録するメタデータ (切り替え時にアプリを再起動せずに済むようにする)
+ACTIVE_CONTAINER_POINTER_ID = "activeHistoryContainer"
+
+def get_cosmos_db_database(client: CosmosClient):
+    """Cosmos DBのデータベースを取得または作成する。"""
+    database_name = os.getenv("AZURE_COSMOS_DB_DATABASE_NAME", "cwbh-app-db")
+    return client.create_database_if_not_exists(id=database_name)
+
+def _metadata_container_name() -> str:
+    return os.getenv("AZURE_COSMOS_DB_METADATA_CONTAINER_NAME", "AppMetadata")
+
+def get_metadata_container(database):
+    """アプリのメタデータ (現在使用中の履歴コンテナー名など) を保存するコンテナーを取得または作成する。"""
+    return database.create_container_if_not_exists(
+        id=_metadata_container_name(),
+        partition_key=PartitionKey(path="/id")
+    )
+
+def get_active_history_container_name(client: CosmosClient) -> str:
+    """
+    現在使用中の履歴コンテナー名を返す。移行ツールによる切り替えが行われていなければ環境変数の値を返す。
+    アプリから定期的に呼ばれるため、データベースやコンテナーの作成 (コントロールプレーンの呼び出し) は行わず、
+    ポインターのドキュメントを1件読むだけにする。メタデータコンテナーが未作成の場合も環境変数の値を返す。
+    """
+    default_name = os.getenv("AZURE_COSMOS_DB_CONTAINER_NAME", "ImageTranslations")
+    database_name = os.getenv("AZURE_COSMOS_DB_DATABASE_NAME", "cwbh-app-db")
+    try:
+        metadata_container = client.get_database_client(database_name).get_container_client(_metadata_container_name())
+        pointer = metadata_container.read_item(item=ACTIVE_CONTAINER_POINTER_ID, partition_key=ACTIVE_CONTAINER_POINTER_ID)
+        return pointer.get("containerName") or default_name
+    except cosmos_exceptions.CosmosResourceNotFoundError:
+        return default_name
+
+def set_active_history_container_name(client: CosmosClient, container_name: str):
+    """使用する履歴コンテナーを切り替える (移行ツールのカットオーバーで使用)。"""
+    metadata_container = get_metadata_container(get_cosmos_db_database(client))
+    metadata_container.upsert_item(body={"id": ACTIVE_CONTAINER_POINTER_ID, "containerName": container_name})
+    print(f"Active history container switched to '{container_name}'.")
+
+# 通常の (範囲) インデックスから除外するパス。
+# 既定のインデックスポリシーは全プロパティを範囲インデックスするため、ベクトルの各要素やチャンクの訳文まで
+# インデックスされ、書き込みRUとインデックスサイズが増える。これらのフィールドは絞り込みに使わないため除外する。
+# (/embedding はベクトルインデックスで検索するため、範囲インデックスからは除外する)
+HISTORY_INDEX_EXCLUDED_PATHS = [
+    "/embedding/*",
+    "/chunkEmbeddings/*",
+    "/translatedChunks/*",
+    "/\"_etag\"/?",
+]
+
+def build_history_indexing_policy(base_policy: dict = None) -> dict:
+    """
+    履歴コンテナーのインデックスポリシーを返す。
+
+    Args:
+        base_policy (dict): 引き継ぐインデックスポリシー (移行元コンテナーのポリシーなど)。省略時は既定のポリシー。
+
+    Returns:
+        dict: base_policy に HISTORY_INDEX_EXCLUDED_PATHS の除外パスを追加したポリシー。
+    """
+    policy = dict(base_policy or {"indexingMode": "consistent", "automatic": True, "includedPaths": [{"path": "/*"}]})
+    excluded_paths = list(policy.get("excludedPaths") or [])
+    existing_paths = {excluded["path"] for excluded in excluded_paths}
+    excluded_paths += [{"path": path} for path in HISTORY_INDEX_EXCLUDED_PATHS if path not in existing_paths]
+    policy["excludedPaths"] = excluded_paths
+    return policy
+
+def get_cosmos_db_container(client: CosmosClient, container_name: str = None, partition_strategy: str = None):
+    """
+    Cosmos DBのデータベースとコンテナーを取得または作成する。
+    Args:
+        client: Cosmos DBクライアント。
+        container_name (str): コンテナー名。省略時は現在使用中の履歴コンテナー。
+        partition_strategy (str): 新規作成時のパーティションキー戦略。省略時は環境変数の値 (partitioning.py を参照)。
+    """
     database_name = os.getenv("AZURE_COSMOS_DB_DATABASE_NAME", "cwbh-app-db")
-    container_name = os.getenv("AZURE_COSMOS_DB_CONTAINER_NAME", "ImageTranslations")
+    container_name = container_name or get_active_history_container_name(client)
+    partition_strategy = partition_strategy or get_configured_partition_strategy()
     
     try:
-        database = client.create_database_if_not_exists(id=database_name)
-        # パーティションキーはユースケースに合わせて変更可能。
-        # シンプルな構成のため、各ドキュメントが一意のIDを持つことを前提に "/id" を使用。
-        # 大量データや特定のクエリパターンがある場合は、より適切なパーティションキーを検討。
+        database = get_cosmos_db_database(client)
+        # パーティションキーは作成時のみ適用される。既存コンテナーの戦略はパーティションキー定義から判定する。
+        # 既存コンテナーの戦略を変更する場合は migrate_history_container.py で新しいコンテナーへ移行する。
+        # インデックスポリシーも作成時のみ適用される (既存コンテナーはポータル等で除外パスを追加する)。
         container = database.create_container_if_not_exists(
             id=container_name,
-            partition_key=PartitionKey(path="/id"),
+            partition_key=build_partition_key(partition_strategy),
+            indexing_policy=build_history_indexing_policy(),
             offer_throughput=400 # 無料枠を意識した初期スループット (必要に応じて調整)
         )
         print(f"Cosmos DB container '{container_name}' in database '{database_name}' is ready.")
@@ -36,20 +123,151 @@ def get_cosmos_db_container(client: CosmosClient):
 
 def save_translation_to_cosmos(container, item: dict):
     """翻訳データをCosmos DBに保存する。"""
+    add_partition_fields(item) # どのパーティションキー戦略でも保存・移行できるようにキー用フィールドを補完
     try:
-        container.upsert_item(body=item) # create_itemからupsert_itemに変更し、ID重複時の更新も可能に
+        # create_itemからupsert_itemに変更し、ID重複時の更新も可能に (RU消費量はプロファイラーで計測)
+        profile_cosmos_upsert(container, item)
         print(f"Item with id '{item.get('id')}' saved to Cosmos DB.")
     except cosmos_exceptions.CosmosHttpResponseError as e:
         print(f"Error saving item id '{item.get('id')}' to Cosmos DB: {e}")
         raise
 
+# 検索結果としてUIに表示するフィールド (embeddingなどの大きなフィールドは取得しない)
+HISTORY_PROJECTION_FIELDS = [
+    "id", "originalImageName", "originalImageUrl", "processedImageUrl",
+    "originalText", "translatedText", "createdAt",
+]
+
+def _history_projection() -> str:
+    return ", ".join(f"c.{field}" for field in HISTORY_PROJECTION_FIELDS)
+
+def _to_utc_iso(value, end_of_day: bool = False) -> str:
+    """date/datetime/文字列を createdAt と比較可能なISO 8601形式 (UTC) に変換する。"""
+    if isinstance(value, str):
+        # 文字列も createdAt と同じ形式 (タイムゾーン付きUTC) に揃える。日付のみの文字列は date と同様に扱う
+        try:
+            value = date.fromisoformat(value) if len(value) == 10 else datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            raise ValueError(f"日付として解釈できない値です: {value!r}")
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value.astimezone(timezone.utc).isoformat()
+    if isinstance(value, date):
+        # 日付のみ指定された場合、終了日はその日の終わりまでを含める (翌日0時未満)
+        day = value + timedelta(days=1) if end_of_day else value
+        return datetime.combine(day, time.min, tzinfo=timezone.utc).isoformat()
+    raise ValueError(f"日付として解釈できない値です: {value!r}")
+
+def build_history_filter_clause(filters: dict = None) -> tuple:
+    """
+    検索の絞り込み条件をCosmos DBのWHERE句とパラメーターに変換する。
+    Args:
+        filters (dict): 以下のキーを任意に含む辞書。
+            created_from: この日時以降に作成された履歴 (date, datetime, ISO文字列)。
+            created_to: この日時より前に作成された履歴 (dateの場合はその日を含む)。
+            original_lang (str): 原文の言語コード (例: "en")。
+            translated_lang (str): 訳文の言語コード (例: "ja")。
+            image_name (str): 元ファイル名に含まれる文字列 (大文字小文字を区別しない)。
+            tenant_id (str): テナント/ユーザーキー。ここではWHERE句に含めず、パーティションの絞り込みに使用する
+                             (_history_query_conditions を参照)。
+    Returns:
+        tuple: (WHERE句の条件リスト, パラメーターリスト)
+    """
+    clauses, parameters = [], []
+    if not filters:
+        return clauses, parameters
+    if filters.get("created_from"):
+        clauses.append("c.createdAt >= @created_from")
+        parameters.append({"name": "@created_from", "value": _to_utc_iso(filters["created_from"])})
+    if filters.get("created_to"):
+        clauses.append("c.createdAt < @created_to")
+        parameters.append({"name": "@created_to", "value": _to_utc_iso(filters["created_to"], end_of_day=True)})
+    if filters.get("original_lang"):
+        clauses.append("c.originalLang = @original_lang")
+        parameters.append({"name": "@original_lang", "value": filters["original_lang"]})
+    if filters.get("translated_lang"):
+        clauses.append("c.translatedLang = @translated_lang")
+        parameters.append({"name": "@translated_lang", "value": filters["translated_lang"]})
+    if filters.get("image_name"):
+        clauses.append("CONTAINS(c.originalImageName, @image_name, true)")
+        parameters.append({"name": "@image_name", "value": filters["image_name"]})
+    return clauses, parameters
+
+def _history_query_conditions(container, filters: dict = None) -> tuple:
+    """
+    絞り込み条件から、WHERE句の条件とパラメーター、単一パーティションで実行できるかを判定した query_items の引数を返す。
+    Returns:
+        tuple: (WHERE句の条件リスト, パラメーターリスト, query_items に渡す引数)
+    """
+    filters = filters or {}
+    strategy = get_container_partition_strategy(container)
+    clauses, parameters = build_history_filter_clause(filters)
+    tenant_clauses, tenant_parameters = build_tenant_filter_clause(strategy, filters.get("tenant_id"))
+    created_from = _to_utc_iso(filters["created_from"]) if filters.get("created_from") else None
+    created_to = _to_utc_iso(filters["created_to"], end_of_day=True) if filters.get("created_to") else None
+    query_scope = resolve_query_scope(
+        strategy,
+        tenant_id=filters.get("tenant_id"),
+        created_from=created_from,
+        created_to=created_to
+    )
+    return clauses + tenant_clauses, parameters + tenant_parameters, query_scope
+
+# チャンクごとのベクトルで並べ替える際、ベクトルインデックスから取得する候補数 (top_kの倍数)
+CHUNK_RERANK_CANDIDATE_FACTOR = 3
+
+def _rerank_by_best_chunk(items: list, query_embedding: list) -> list:
+    """
+    チャンクごとのベクトル (chunkEmbeddings) を持つドキュメントを、最も近いチャンクの類似度で並べ替える。
+    ベクトルインデックスはドキュメントの代表ベクトルで候補を絞り込み、最終的な順位は最も一致するチャンクで決める。
+    類似度はコサイン類似度 (コンテナーのベクトルポリシーが cosine の場合のVectorDistanceと同じ尺度)。
+    """
+    reranked = False
+    for item in items:
+        chunk_embeddings = item.pop("chunkEmbeddings", None)
+        if chunk_embeddings:
+            scores = [cosine_similarity(query_embedding, dequantize_vector(vector)) for vector in chunk_embeddings]
+            best_index = max(range(len(scores)), key=scores.__getitem__)
+            item["similarityScore"] = scores[best_index]
+            item["bestChunkIndex"] = best_index
+            reranked = True
+    if reranked:
+        items.sort(key=lambda item: item.get("similarityScore") or 0.0, reverse=True)
+    return items
+
+def _build_vector_query(filter_clauses: list) -> str:
+    """ベクトル検索クエリを組み立てる。絞り込み条件はWHERE句に含めてサーバー側で評価させる。"""
+    where_clauses = ["IS_DEFINED(c.embedding)", "IS_ARRAY(c.embedding)"] + filter_clauses
+    # VectorDistanceのORDER BY句から 'ASC' を削除
+    # VectorDistanceはデフォルトで昇順（距離が近い順）にソートするため、ASC/DESCの指定は不要
+    return (
+        f"SELECT TOP @top_k {_history_projection()}, c.chunkEmbeddings, "
+        f"VectorDistance(c.embedding, @query_vector) AS similarityScore "
+        f"FROM c "
+        f"WHERE {' AND '.join(where_clauses)} "
+        f"ORDER BY VectorDistance(c.embedding, @query_vector)"
+    )
+
+def _build_fulltext_query(filter_clauses: list, use_top: bool) -> str:
+    """全文検索クエリを組み立てる。ページングする場合は use_top=False でTOPを付けない。"""
+    # 全文検索用のクエリ。CONTAINS関数で日本語テキストを検索。3番目の引数 true で大文字小文字を無視
+    where_clauses = ["CONTAINS(c.translatedText, @query_text, true)"] + filter_clauses
+    top = "TOP @top_k " if use_top else ""
+    return (
+        f"SELECT {top}{_history_projection()} "
+        f"FROM c "
+        f"WHERE {' AND '.join(where_clauses)}"
+    )
+
 # 検索関数
 def search_histories_cosmos(
     container,
     embeddings_service: AzureOpenAIEmbeddings,
     query_text: str,
     search_mode: str = 'hybrid',
-    top_k: int = 5
+    top_k: int = 5,
+    filters: dict = None
 ) -> list:
     """
     Cosmos DBで履歴を検索する。モードに応じてベクトル検索、全文検索、ハイブリッド検索を切り替える。
@@ -59,35 +277,34 @@ def search_histories_cosmos(
         query_text (str): ユーザーからの検索クエリ。
         search_mode (str): 'vector', 'fulltext', または 'hybrid'。
         top_k (int): 取得する最大件数。
+        filters (dict): 絞り込み条件 (build_history_filter_clause を参照)。
     Returns:
         list: 検索結果のドキュメントリスト。
     """
     if not query_text: return []
     
     results = []
+    filter_clauses, filter_parameters, query_scope = _history_query_conditions(container, filters)
     
     # --- ベクトル検索の実行 ---
     if search_mode in ['vector', 'hybrid']:
         try:
             query_embedding = embeddings_service.embed_query(query_text)
-            # VectorDistanceのORDER BY句から 'ASC' を削除
-            # VectorDistanceはデフォルトで昇順（距離が近い順）にソートするため、ASC/DESCの指定は不要
-            vector_query = (
-                f"SELECT TOP @top_k c.id, c.originalImageName, c.originalImageUrl, c.processedImageUrl, "
-                f"c.originalText, c.translatedText, c.createdAt, VectorDistance(c.embedding, @query_vector) AS similarityScore "
-                f"FROM c "
-                f"WHERE IS_DEFINED(c.embedding) AND IS_ARRAY(c.embedding) "
-                f"ORDER BY VectorDistance(c.embedding, @query_vector)"
-            )
+            vector_query = _build_vector_query(filter_clauses)
             print(f"Executing Vector Search with top_k={top_k}...")
-            vector_results = list(container.query_items(
-                query=vector_query,
-                parameters=[
+            vector_results = profile_cosmos_query(
+                container,
+                vector_query,
+                [
                     {"name": "@query_vector", "value": query_embedding},
-                    {"name": "@top_k", "value": top_k}
-                ],
-                enable_cross_partition_query=True
-            ))
+                    {"name": "@top_k", "value": top_k * CHUNK_RERANK_CANDIDATE_FACTOR}
+                ] + filter_parameters,
+                query_shape="vector_search",
+                search_mode=search_mode,
+                top_k=top_k,
+                **query_scope
+            )
+            vector_results = _rerank_by_best_chunk(vector_results, query_embedding)[:top_k]
             results.extend(vector_results)
             print(f"Vector search found {len(vector_results)} results.")
         except Exception as e:
@@ -97,23 +314,20 @@ def search_histories_cosmos(
     # --- 全文検索の実行 ---
     if search_mode in ['fulltext', 'hybrid']:
         try:
-            # 全文検索用のクエリ。CONTAINS関数で日本語テキストを検索。
-            # 大文字小文字を区別しないようにLOWER関数を使うとより良い。
-            fulltext_query = (
-                f"SELECT TOP @top_k c.id, c.originalImageName, c.originalImageUrl, c.processedImageUrl, "
-                f"c.originalText, c.translatedText, c.createdAt "
-                f"FROM c "
-                f"WHERE CONTAINS(c.translatedText, @query_text, true)" # 3番目の引数 true で大文字小文字を無視
-            )
+            fulltext_query = _build_fulltext_query(filter_clauses, use_top=True)
             print(f"Executing Full-text Search with query_text='{query_text}'...")
-            fulltext_results = list(container.query_items(
-                query=fulltext_query,
-                parameters=[
+            fulltext_results = profile_cosmos_query(
+                container,
+                fulltext_query,
+                [
                     {"name": "@query_text", "value": query_text},
                     {"name": "@top_k", "value": top_k}
-                ],
-                enable_cross_partition_query=True
-            ))
+                ] + filter_parameters,
+                query_shape="fulltext_search",
+                search_mode=search_mode,
+                top_k=top_k,
+                **query_scope
+            )
             results.extend(fulltext_results)
             print(f"Full-text search found {len(fulltext_results)} results.")
         except Exception as e:
@@ -134,6 +348,129 @@ def search_histories_cosmos(
 
     return results
 
+def iter_search_histories_pages(
+    container,
+    embeddings_service: AzureOpenAIEmbeddings,
+    query_text: str,
+    search_mode: str = 'hybrid',
+    page_size: int = 5,
+    max_results: int = 50,
+    filters: dict = None,
+    continuation_token: str = None
+):
+    """
+    履歴検索をページ単位で実行し、Cosmos DBからページが届くたびに結果を返すジェネレーター。
+    ジェネレーターを保持しておけば、次のページを取得する際に前のページを再実行しない。
+    Args:
+        container: Cosmos DBのコンテナーオブジェクト。
+        embeddings_service: Azure OpenAIの埋め込みサービス。
+        query_text (str): ユーザーからの検索クエリ。
+        search_mode (str): 'vector', 'fulltext', または 'hybrid'。
+        page_size (int): 1ページあたりの最大件数。
+        max_results (int): ベクトル検索で取得する最大件数 (ベクトル検索はTOPの指定が必須のため)。
+        filters (dict): 絞り込み条件 (build_history_filter_clause を参照)。
+        continuation_token (str): 前回yieldされた continuationToken。指定するとその続きから取得する。
+    Yields:
+        dict: {"items": そのページのドキュメントリスト, "continuationToken": 続きを取得するためのトークン (最終ページではNone)}
+              ハイブリッド検索ではベクトル検索のページの後に全文検索のページが続き、
+              同じジェネレーター内で既に返したドキュメントは除外される。
+              ベクトル検索は max_results 件の候補をまとめて取得・並べ替えてからページに分けるため、
+              継続トークンから再開した場合は候補の取得をやり直す (ジェネレーターを保持していれば再実行しない)。
+    """
+    if not query_text: return
+
+    filter_clauses, filter_parameters, query_scope = _history_query_conditions(container, filters)
+    phases = ['vector', 'fulltext'] if search_mode == 'hybrid' else [search_mode]
+
+    # 継続トークンは、ベクトル検索では {"phase": "vector", "offset": 次の位置}、
+    # 全文検索では {"phase": "fulltext", "token": Cosmos DBの継続トークン} をJSON化したもの
+    resume_phase, resume = None, {}
+    if continuation_token:
+        resume = json.loads(continuation_token)
+        resume_phase = resume["phase"]
+        phases = phases[phases.index(resume_phase):]
+
+    seen_ids = set()
+    for phase_index, phase in enumerate(phases):
+        next_phase = phases[phase_index + 1] if phase_index + 1 < len(phases) else None
+        resume_state = resume if phase == resume_phase else {}
+        try:
+            if phase == 'vector':
+                pages = _iter_reranked_vector_pages(
+                    container,
+                    embeddings_service.embed_query(query_text),
+                    filter_clauses,
+                    filter_parameters,
+                    query_scope,
+                    search_mode=search_mode,
+                    page_size=page_size,
+                    max_results=max_results,
+                    offset=resume_state.get("offset") or 0
+                )
+            else:
+                fulltext_pages = iter_profiled_query_pages(
+                    container,
+                    _build_fulltext_query(filter_clauses, use_top=False),
+                    [{"name": "@query_text", "value": query_text}] + filter_parameters,
+                    query_shape="fulltext_search_paged",
+                    search_mode=search_mode,
+                    top_k=page_size,
+                    page_size=page_size,
+                    continuation_token=resume_state.get("token"),
+                    **query_scope
+                )
+                pages = ((page_items, {"token": page_token} if page_token else None) for page_items, page_token in fulltext_pages)
+
+            for page_items, page_state in pages:
+                new_items = [item for item in page_items if item['id'] not in seen_ids]
+                seen_ids.update(item['id'] for item in new_items)
+                if page_state:
+                    token = json.dumps({"phase": phase, **page_state})
+                elif next_phase:
+                    token = json.dumps({"phase": next_phase})
+                else:
+                    token = None
+                print(f"Paged {phase} search returned {len(new_items)} new results.")
+                yield {"items": new_items, "continuationToken": token}
+        except Exception as e:
+            print(f"Error during paged {phase} search: {e}")
+            if search_mode != 'hybrid': raise # 単一モードの場合はエラーを再スロー
+
+def _iter_reranked_vector_pages(
+    container,
+    query_embedding: list,
+    filter_clauses: list,
+    filter_parameters: list,
+    query_scope: dict,
+    search_mode: str,
+    page_size: int,
+    max_results: int,
+    offset: int = 0
+):
+    """
+    ベクトル検索の候補 (最大 max_results 件) をまとめて取得し、最も近いチャンクで全体を並べ替えてから
+    page_size 件ずつ返すジェネレーター。ページごとに並べ替えるとページをまたいだ順位が逆転するため、
+    並べ替えは候補全体に対して1回だけ行う。
+    Yields:
+        tuple: (そのページのドキュメントリスト, 続きの状態 {"offset": 次の位置} (最終ページではNone))
+    """
+    candidates = profile_cosmos_query(
+        container,
+        _build_vector_query(filter_clauses),
+        [
+            {"name": "@query_vector", "value": query_embedding},
+            {"name": "@top_k", "value": max_results}
+        ] + filter_parameters,
+        query_shape="vector_search_paged",
+        search_mode=search_mode,
+        top_k=max_results,
+        **query_scope
+    )
+    candidates = _rerank_by_best_chunk(candidates, query_embedding)
+    for start in range(offset, len(candidates), page_size):
+        end = start + page_size
+        yield candidates[start:end], ({"offset": end} if end < len(candidates) else None)
+
 # --- Blob Storage Functions ---
 
 def init_blob_service_client() -> BlobServiceClient:
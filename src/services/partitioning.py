@@ -0,0 +1,172 @@
+import os
+from datetime import datetime, timedelta
+from azure.cosmos import PartitionKey
+
+# このファイルでは、履歴コンテナーのパーティションキー戦略を定義します。
+# - id           : "/id" (従来の構成。全クエリがクロスパーティションになる)
+# - time_bucket  : "/createdMonth" (createdAt から導出した "YYYY-MM"。同じ月に収まる期間検索は単一パーティション)
+# - hierarchical : ["/tenantId", "/createdMonth"] (階層パーティションキー。テナントのみの指定でもプレフィックスで絞り込める)
+# テナント/ユーザーキーは、App Serviceの認証 (Easy Auth) が付与するリクエストヘッダーのユーザーIDから取得する。
+# 認証が無効な環境では全ドキュメントが同じテナントになるため、"/tenantId" だけをキーにする戦略は用意していない
+# (1つの論理パーティションの容量20GBとスループット上限に集中してしまう)。階層キーなら月ごとに分散される。
+# コンテナーの戦略は作成時のパーティションキー定義から判定するため、アプリとコンテナーの設定がずれることはありません。
+# 移行前のドキュメントや認証が無効な環境で保存したドキュメントは既定のテナントキーになるため、階層パーティション戦略の検索では
+# 既定では自分のテナントに加えて既定のテナントも検索する (移行後にログインユーザーから過去の履歴が見えなくならないように)。
+
+PARTITION_STRATEGIES = {
+    "id": ["/id"],
+    "time_bucket": ["/createdMonth"],
+    "hierarchical": ["/tenantId", "/createdMonth"],
+}
+
+DEFAULT_TENANT_ID = "default"
+
+# App Serviceの認証 (Easy Auth) が付与するログインユーザーIDのヘッダー
+CLIENT_PRINCIPAL_ID_HEADER = "X-MS-CLIENT-PRINCIPAL-ID"
+
+# コンテナーIDごとに判定済みの戦略をキャッシュ (コンテナー定義の読み取りは1回だけにする)
+_container_strategy_cache = {}
+
+
+def get_configured_partition_strategy() -> str:
+    """新規に作成するコンテナーのパーティションキー戦略を環境変数から取得する。"""
+    strategy = os.getenv("AZURE_COSMOS_DB_PARTITION_STRATEGY", "id")
+    if strategy not in PARTITION_STRATEGIES:
+        raise ValueError(f"不明なパーティションキー戦略です: '{strategy}' (指定可能: {', '.join(PARTITION_STRATEGIES)})")
+    return strategy
+
+
+def get_default_tenant_id() -> str:
+    """ユーザーを特定できない場合に使うテナント/ユーザーキーを環境変数から取得する。"""
+    return os.getenv("AZURE_COSMOS_DB_TENANT_ID", DEFAULT_TENANT_ID)
+
+
+def includes_default_tenant() -> bool:
+    """階層パーティション戦略の検索で、既定のテナント (移行前のドキュメントなど) も検索対象に含めるかを環境変数から取得する。"""
+    return os.getenv("AZURE_COSMOS_DB_SEARCH_DEFAULT_TENANT", "true").lower() in ("1", "true", "yes")
+
+
+def get_searchable_tenant_ids(tenant_id: str) -> list:
+    """検索対象のテナントキー一覧 (自分のテナントと、設定に応じて既定のテナント) を返す。"""
+    default_tenant_id = get_default_tenant_id()
+    if tenant_id == default_tenant_id or not includes_default_tenant():
+        return [tenant_id]
+    return [tenant_id, default_tenant_id]
+
+
+def get_tenant_id_from_headers(headers) -> str:
+    """
+    リクエストヘッダーからテナント/ユーザーキーを取得する。
+
+    Args:
+        headers: リクエストヘッダー (大文字小文字を区別しないマッピング。Streamlitでは st.context.headers)。
+
+    Returns:
+        str: App Serviceの認証で付与されたログインユーザーID。取得できない場合は get_default_tenant_id() の値。
+    """
+    principal_id = headers.get(CLIENT_PRINCIPAL_ID_HEADER) if headers else None
+    return principal_id or get_default_tenant_id()
+
+
+def build_partition_key(strategy: str) -> PartitionKey:
+    """戦略に対応するPartitionKey定義を返す。"""
+    paths = PARTITION_STRATEGIES[strategy]
+    if len(paths) > 1:
+        return PartitionKey(path=paths, kind="MultiHash") # 階層パーティションキー
+    return PartitionKey(path=paths[0])
+
+
+def get_container_partition_strategy(container) -> str:
+    """
+    コンテナーのパーティションキー定義から戦略を判定する。
+
+    Args:
+        container: Cosmos DBのコンテナーオブジェクト。
+
+    Returns:
+        str: 戦略名。定義が既知の戦略に一致しない場合は 'id' とみなす (常にクロスパーティションで検索する)。
+    """
+    if container.id not in _container_strategy_cache:
+        paths = container.read().get("partitionKey", {}).get("paths", [])
+        strategy = next((name for name, strategy_paths in PARTITION_STRATEGIES.items() if strategy_paths == paths), "id")
+        print(f"Container '{container.id}' uses partition strategy '{strategy}' ({paths}).")
+        _container_strategy_cache[container.id] = strategy
+    return _container_strategy_cache[container.id]
+
+
+def add_partition_fields(item: dict) -> dict:
+    """
+    どの戦略でも使えるように、パーティションキー用のフィールド (tenantId, createdMonth) を補完する。
+    既に値がある場合は上書きしない。
+    """
+    if not item.get("tenantId"):
+        item["tenantId"] = get_default_tenant_id()
+    if item.get("createdAt") and not item.get("createdMonth"):
+        item["createdMonth"] = item["createdAt"][:7] # "YYYY-MM-DDTHH:MM:SS..." -> "YYYY-MM"
+    return item
+
+
+def _months_in_range(created_from: str, created_to: str) -> list:
+    """[created_from, created_to) に含まれる "YYYY-MM" の一覧を返す。どちらかが未指定の場合は空リスト。"""
+    if not created_from or not created_to:
+        return []
+    try:
+        start = datetime.fromisoformat(created_from.replace('Z', '+00:00'))
+        end = datetime.fromisoformat(created_to.replace('Z', '+00:00')) - timedelta(microseconds=1) # 終了は排他的
+        if end < start:
+            return []
+    except (ValueError, TypeError):
+        # 解釈できない値やタイムゾーンの有無が混在する値は、月を特定せずクロスパーティションで検索させる
+        return []
+    months = []
+    year, month = start.year, start.month
+    while (year, month) <= (end.year, end.month):
+        months.append(f"{year:04d}-{month:02d}")
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+def resolve_query_scope(strategy: str, tenant_id: str = None, created_from: str = None, created_to: str = None) -> dict:
+    """
+    検索条件から、単一パーティションに絞り込めるかを判定し、query_items に渡す引数を返す。
+
+    Args:
+        strategy (str): コンテナーのパーティションキー戦略。
+        tenant_id (str): 検索対象のテナント/ユーザーキー。
+        created_from (str): 期間の開始 (ISO 8601, UTC)。
+        created_to (str): 期間の終了 (ISO 8601, UTC, 排他的)。
+
+    Returns:
+        dict: {"partition_key": ...} または {"enable_cross_partition_query": True}
+    """
+    months = _months_in_range(created_from, created_to)
+    single_month = months[0] if len(months) == 1 else None
+
+    if strategy == "time_bucket" and single_month:
+        return {"partition_key": single_month}
+    if strategy == "hierarchical" and tenant_id and len(get_searchable_tenant_ids(tenant_id)) > 1:
+        # 複数のテナントは1つのパーティションキーで指定できないため、build_tenant_filter_clause のWHERE句で絞り込む
+        # (パーティションキーの条件はクエリプランで対象のパーティションに絞り込まれる)
+        return {"enable_cross_partition_query": True}
+    if strategy == "hierarchical" and tenant_id:
+        if single_month:
+            return {"partition_key": [tenant_id, single_month]}
+        return {"partition_key": [tenant_id]} # プレフィックス (テナントのみ) での絞り込み
+    return {"enable_cross_partition_query": True}
+
+
+def build_tenant_filter_clause(strategy: str, tenant_id: str = None) -> tuple:
+    """
+    階層パーティション戦略で複数のテナントを検索する場合のWHERE句の条件を返す。
+    単一のテナントの場合は resolve_query_scope のパーティションキーで絞り込むため、条件は不要。
+
+    Returns:
+        tuple: (WHERE句の条件リスト, パラメーターリスト)
+    """
+    if strategy != "hierarchical" or not tenant_id:
+        return [], []
+    tenant_ids = get_searchable_tenant_ids(tenant_id)
+    if len(tenant_ids) == 1:
+        return [], []
+    names = [f"@tenant_id_{index}" for index in range(len(tenant_ids))]
+    return [f"c.tenantId IN ({', '.join(names)})"], [{"name": name, "value": value} for name, value in zip(names, tenant_ids)]
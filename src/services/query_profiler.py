@@ -0,0 +1,341 @@
+import os
+import time
+import threading
+
+# Cosmos DBのレスポンスヘッダー名
+REQUEST_CHARGE_HEADER = "x-ms-request-charge"
+QUERY_METRICS_HEADER = "x-ms-documentdb-query-metrics"
+INDEX_METRICS_HEADER = "x-ms-cosmos-index-utilization"
+
+# このファイルでは、Cosmos DBへのクエリ・書き込みごとのRU消費量とレイテンシーを計測し、
+# クエリの種類 (query_shape)・検索モード・top_k ごとに集計します。
+# 集計結果は get_query_profile_summary() で取得でき、Streamlitのデバッグパネルからも参照できます。
+
+
+def _parse_query_metrics(header_value: str) -> list:
+    """
+    x-ms-documentdb-query-metrics ヘッダー ("key=value;key=value;...") をパーティションごとの辞書のリストに変換する。
+    クロスパーティションクエリでは複数パーティション分がカンマ区切りで返ることがある。
+    """
+    partitions = []
+    if not header_value:
+        return partitions
+    for partition_metrics in header_value.split(","):
+        metrics = {}
+        for pair in partition_metrics.split(";"):
+            if "=" not in pair:
+                continue
+            key, value = pair.split("=", 1)
+            try:
+                metrics[key.strip()] = float(value)
+            except ValueError:
+                continue
+        if metrics:
+            partitions.append(metrics)
+    return partitions
+
+
+class QueryProfiler:
+    """
+    Cosmos DB操作の計測値をクエリ形状・検索モード・top_kごとに集計するクラス。
+    Streamlitでは複数セッションから同時に呼ばれるため、集計はロックで保護する。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._recent = []
+        self.max_recent = 50 # 直近の個別計測値を保持する件数
+
+    def record(self, profile: dict):
+        """1回分の計測値 (profile_cosmos_query / profile_cosmos_upsert の戻り値) を集計に加える。"""
+        key = (profile["queryShape"], profile["searchMode"], profile["topK"])
+        with self._lock:
+            stats = self._stats.setdefault(key, {
+                "queryShape": profile["queryShape"],
+                "searchMode": profile["searchMode"],
+                "topK": profile["topK"],
+                "calls": 0,
+                "totalRequestCharge": 0.0,
+                "maxRequestCharge": 0.0,
+                "totalServerTimeMs": 0.0,
+                "totalClientTimeMs": 0.0,
+                "totalPages": 0,
+                "totalItems": 0,
+                "totalRetrievedDocuments": 0.0,
+                "indexUtilizationWeightedSum": 0.0,
+                "indexUtilizationWeight": 0.0,
+            })
+            stats["calls"] += 1
+            stats["totalRequestCharge"] += profile["requestCharge"]
+            stats["maxRequestCharge"] = max(stats["maxRequestCharge"], profile["requestCharge"])
+            stats["totalServerTimeMs"] += profile["serverTimeMs"]
+            stats["totalClientTimeMs"] += profile["clientTimeMs"]
+            stats["totalPages"] += profile["pageCount"]
+            stats["totalItems"] += profile["itemCount"]
+            stats["totalRetrievedDocuments"] += profile["retrievedDocumentCount"]
+            # インデックス利用率は読み取ったドキュメント数で重み付けして平均する
+            stats["indexUtilizationWeightedSum"] += profile["indexUtilizationWeightedSum"]
+            stats["indexUtilizationWeight"] += profile["indexUtilizationWeight"]
+
+            self._recent.append(profile)
+            if len(self._recent) > self.max_recent:
+                self._recent = self._recent[-self.max_recent:]
+
+    def summary(self) -> list:
+        """
+        集計結果を返す。
+
+        Returns:
+            list: クエリ形状・検索モード・top_kごとの集計値 (平均RU、平均サーバー時間などを含む) の辞書リスト。
+                  合計RUの大きい順に並ぶ。
+        """
+        with self._lock:
+            rows = []
+            for stats in self._stats.values():
+                calls = stats["calls"]
+                weight = stats["indexUtilizationWeight"]
+                rows.append({
+                    "queryShape": stats["queryShape"],
+                    "searchMode": stats["searchMode"],
+                    "topK": stats["topK"],
+                    "calls": calls,
+                    "totalRequestCharge": round(stats["totalRequestCharge"], 2),
+                    "avgRequestCharge": round(stats["totalRequestCharge"] / calls, 2),
+                    "maxRequestCharge": round(stats["maxRequestCharge"], 2),
+                    "avgServerTimeMs": round(stats["totalServerTimeMs"] / calls, 2),
+                    "avgClientTimeMs": round(stats["totalClientTimeMs"] / calls, 2),
+                    "avgPages": round(stats["totalPages"] / calls, 2),
+                    "avgItems": round(stats["totalItems"] / calls, 2),
+                    "avgRetrievedDocuments": round(stats["totalRetrievedDocuments"] / calls, 2),
+                    "avgIndexUtilization": round(stats["indexUtilizationWeightedSum"] / weight, 3) if weight else None,
+                })
+        return sorted(rows, key=lambda row: row["totalRequestCharge"], reverse=True)
+
+    def recent(self) -> list:
+        """直近の個別計測値を新しい順に返す。"""
+        with self._lock:
+            return list(reversed(self._recent))
+
+    def reset(self):
+        """集計結果をすべて破棄する。"""
+        with self._lock:
+            self._stats.clear()
+            self._recent.clear()
+
+
+# アプリ全体で共有するプロファイラー
+query_profiler = QueryProfiler()
+
+
+def _index_metrics_enabled() -> bool:
+    """インデックス利用状況の詳細メトリクスを要求するかどうか (追加のRUがかかるため既定では無効)。"""
+    return os.getenv("AZURE_COSMOS_DB_INDEX_METRICS", "false").lower() in ("1", "true", "yes")
+
+
+def _new_profile(query_shape: str, search_mode: str, top_k) -> dict:
+    return {
+        "queryShape": query_shape,
+        "searchMode": search_mode,
+        "topK": top_k,
+        "requestCharge": 0.0,
+        "serverTimeMs": 0.0,
+        "clientTimeMs": 0.0,
+        "pageCount": 0,
+        "itemCount": 0,
+        "retrievedDocumentCount": 0.0,
+        "indexUtilizationRatio": None,
+        "indexUtilizationWeightedSum": 0.0,
+        "indexUtilizationWeight": 0.0,
+        "indexMetrics": None,
+    }
+
+
+def _apply_response_headers(profile: dict, headers: dict):
+    """1ページ (1リクエスト) 分のレスポンスヘッダーを計測値に加算する。"""
+    if not headers:
+        return
+    try:
+        profile["requestCharge"] += float(headers.get(REQUEST_CHARGE_HEADER, 0) or 0)
+    except ValueError:
+        pass
+    for partition_metrics in _parse_query_metrics(headers.get(QUERY_METRICS_HEADER, "")):
+        retrieved = partition_metrics.get("retrievedDocumentCount", 0.0)
+        profile["serverTimeMs"] += partition_metrics.get("totalExecutionTimeInMs", 0.0)
+        profile["retrievedDocumentCount"] += retrieved
+        if "indexUtilizationRatio" in partition_metrics:
+            # 比率は合算せず、パーティション・ページをまたいで読み取りドキュメント数で重み付け平均する
+            # (読み取り件数が報告されない場合は1件分として扱う)
+            weight = retrieved if "retrievedDocumentCount" in partition_metrics else 1.0
+            profile["indexUtilizationWeightedSum"] += partition_metrics["indexUtilizationRatio"] * weight
+            profile["indexUtilizationWeight"] += weight
+    if profile["indexUtilizationWeight"]:
+        profile["indexUtilizationRatio"] = profile["indexUtilizationWeightedSum"] / profile["indexUtilizationWeight"]
+    if headers.get(INDEX_METRICS_HEADER):
+        profile["indexMetrics"] = headers.get(INDEX_METRICS_HEADER)
+
+
+def profile_cosmos_query(
+    container,
+    query: str,
+    parameters: list,
+    query_shape: str,
+    search_mode: str,
+    top_k=None,
+    **query_kwargs
+) -> list:
+    """
+    Cosmos DBのクエリを実行し、RU消費量・サーバー実行時間・ページ数・インデックス利用率を計測する。
+
+    Args:
+        container: Cosmos DBのコンテナーオブジェクト。
+        query (str): 実行するクエリ。
+        parameters (list): クエリパラメーター。
+        query_shape (str): 集計用のクエリ形状名 (例: 'vector_search')。
+        search_mode (str): 集計用の検索モード ('vector', 'fulltext', 'hybrid' など)。
+        top_k: 集計用のtop_k値。
+        **query_kwargs: container.query_items にそのまま渡す追加引数。
+
+    Returns:
+        list: クエリ結果のドキュメントリスト。
+    """
+    profile = _new_profile(query_shape, search_mode, top_k)
+
+    # response_hook はバックエンドへのリクエスト (ページ) ごとに呼ばれる
+    def _on_page(headers, _result):
+        profile["pageCount"] += 1
+        _apply_response_headers(profile, headers)
+
+    started = time.perf_counter()
+    try:
+        items = list(container.query_items(
+            query=query,
+            parameters=parameters,
+            populate_query_metrics=True,
+            populate_index_metrics=_index_metrics_enabled(),
+            response_hook=_on_page,
+            **query_kwargs
+        ))
+        profile["itemCount"] = len(items)
+    finally:
+        profile["clientTimeMs"] = (time.perf_counter() - started) * 1000
+        query_profiler.record(profile)
+
+    print(
+        f"[QueryProfile] {query_shape}/{search_mode} top_k={top_k}: "
+        f"{profile['requestCharge']:.2f} RU, server {profile['serverTimeMs']:.2f} ms, "
+        f"client {profile['clientTimeMs']:.1f} ms, pages={profile['pageCount']}, items={len(items)}"
+    )
+    return items
+
+
+def iter_profiled_query_pages(
+    container,
+    query: str,
+    parameters: list,
+    query_shape: str,
+    search_mode: str,
+    top_k=None,
+    page_size: int = None,
+    continuation_token: str = None,
+    **query_kwargs
+):
+    """
+    Cosmos DBのクエリをページ単位で実行し、ページが届くたびに結果を返すジェネレーター。
+    計測値は取得したページごとに1回分として集計する。
+
+    Args:
+        container: Cosmos DBのコンテナーオブジェクト。
+        query (str): 実行するクエリ。
+        parameters (list): クエリパラメーター。
+        query_shape (str): 集計用のクエリ形状名。
+        search_mode (str): 集計用の検索モード。
+        top_k: 集計用のtop_k値。
+        page_size (int): 1ページあたりの最大件数 (max_item_count)。
+        continuation_token (str): 前回の続きから取得する場合の継続トークン。
+        **query_kwargs: container.query_items にそのまま渡す追加引数。
+
+    Yields:
+        tuple: (そのページのドキュメントリスト, 次ページの継続トークン。最終ページではNone)
+    """
+    profile = None
+
+    # response_hook はバックエンドへのリクエストごとに呼ばれ、取得中のページの計測値に加算する
+    def _on_page(headers, _result):
+        if profile is not None:
+            profile["pageCount"] += 1
+            _apply_response_headers(profile, headers)
+
+    pager = container.query_items(
+        query=query,
+        parameters=parameters,
+        max_item_count=page_size,
+        populate_query_metrics=True,
+        populate_index_metrics=_index_metrics_enabled(),
+        response_hook=_on_page,
+        **query_kwargs
+    ).by_page(continuation_token)
+
+    while True:
+        profile = _new_profile(query_shape, search_mode, top_k)
+        items = None
+        should_record = True # profile_cosmos_query と同様に、失敗したページも集計する
+        started = time.perf_counter()
+        try:
+            items = list(next(pager))
+            profile["itemCount"] = len(items)
+        except StopIteration:
+            # 結果のない最終フェッチは、バックエンドへのリクエストが発生した場合のみ集計する
+            should_record = profile["pageCount"] > 0
+        finally:
+            profile["clientTimeMs"] = (time.perf_counter() - started) * 1000
+            if should_record:
+                query_profiler.record(profile)
+        if items is None:
+            return
+        yield items, pager.continuation_token
+        if not pager.continuation_token:
+            return
+
+
+def profile_cosmos_upsert(container, item: dict, query_shape: str = "upsert") -> dict:
+    """
+    Cosmos DBへのupsertを実行し、RU消費量とレイテンシーを計測する。
+
+    Args:
+        container: Cosmos DBのコンテナーオブジェクト。
+        item (dict): 保存するドキュメント。
+        query_shape (str): 集計用の操作名。
+
+    Returns:
+        dict: upsert_item の戻り値。
+    """
+    profile = _new_profile(query_shape, "write", None)
+
+    def _on_response(headers, _result):
+        profile["pageCount"] += 1
+        _apply_response_headers(profile, headers)
+
+    started = time.perf_counter()
+    try:
+        result = container.upsert_item(body=item, response_hook=_on_response)
+        profile["itemCount"] = 1
+    finally:
+        profile["clientTimeMs"] = (time.perf_counter() - started) * 1000
+        query_profiler.record(profile)
+    return result
+
+
+def get_query_profile_summary() -> list:
+    """クエリ形状・検索モード・top_kごとのRU/レイテンシー集計を返す。"""
+    return query_profiler.summary()
+
+
+def get_recent_query_profiles() -> list:
+    """直近の個別クエリの計測値を新しい順に返す。"""
+    return query_profiler.recent()
+
+
+def reset_query_profiles():
+    """クエリプロファイルの集計をリセットする。"""
+    query_profiler.reset()
@@ -0,0 +1,312 @@
+import hashlib
+import os
+import re
+import threading
+import time
+from difflib import SequenceMatcher
+
+from services.partitioning import get_default_tenant_id, get_searchable_tenant_ids
+from services.query_profiler import profile_cosmos_query
+
+# このファイルでは、過去の翻訳を再利用する翻訳メモリーを実装します。
+# OCRの読み取り揺れ・句読点・価格などの数値だけが異なる原文を、Translatorに送らずに過去の訳文で翻訳します。
+# - 原文を正規化 (小文字化・記号除去・数字を0に置換) した文字n-gramのMinHash署名で類似度を推定
+# - LSH (署名をバンドに分けたバケット) によるローカルインデックスで、全件比較せずに候補を絞り込む
+# - 再利用時は、数値だけが異なるトークンを訳文中で置き換える (ポストエディット)
+# - 原文の数値の違いを訳文ですべて置き換えられない場合は、古い価格・数量の訳文を返さないよう再利用しない
+# - 数値以外の単語の違いがOCRの読み取り揺れ程度 (単語内の数文字) を超える場合は、意味が変わりうるため再利用しない
+#   (MinHashの類似度が高くても "keep" と "do not keep" のような否定の追加は訳文に反映できない)
+# - エントリーはテナント/ユーザーキー (tenantId) ごとに管理し、他のユーザーの訳文は再利用しない
+#   (検索と同じく、既定のテナントの訳文は AZURE_COSMOS_DB_SEARCH_DEFAULT_TENANT に従って共有する)
+# - 上限件数に達したら、最も古く追加されたエントリーから削除する
+
+DEFAULT_SIMILARITY_THRESHOLD = 0.9
+SHINGLE_SIZE = 5
+NUM_PERMUTATIONS = 64
+NUM_BANDS = 16 # 1バンドあたり4要素。類似度0.9の組はほぼ確実に候補になる
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+_NUMBER_PATTERN = re.compile(r"\d+(?:[.,]\d+)*")
+# OCRの読み取り揺れとみなす単語の違い: この文字数ごとに1文字までの編集 (最低1文字)
+OCR_NOISE_CHARS_PER_EDIT = 5
+
+
+def _permutation_parameters(count: int) -> list:
+    """MinHashの各ハッシュ関数 (a * x + b mod p) の係数を決定的に生成する。"""
+    parameters = []
+    for i in range(count):
+        digest = hashlib.blake2b(f"translation-memory-{i}".encode(), digest_size=16).digest()
+        a = int.from_bytes(digest[:8], "little") % _MERSENNE_PRIME or 1
+        b = int.from_bytes(digest[8:], "little") % _MERSENNE_PRIME
+        parameters.append((a, b))
+    return parameters
+
+
+_PERMUTATIONS = _permutation_parameters(NUM_PERMUTATIONS)
+
+
+def normalize_source_text(text: str) -> str:
+    """OCRの揺れに影響されないよう原文を正規化する (小文字化、記号除去、数字を0に置換、空白の統一)。"""
+    text = re.sub(r"\d", "0", text.lower())
+    text = re.sub(r"[^\w\s]", " ", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def minhash_signature(text: str) -> tuple:
+    """正規化済みテキストの文字n-gramからMinHash署名を計算する。"""
+    if len(text) <= SHINGLE_SIZE:
+        shingles = {text}
+    else:
+        shingles = {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+    hashed = [int.from_bytes(hashlib.blake2b(s.encode(), digest_size=4).digest(), "little") for s in shingles]
+    return tuple(
+        min(((a * h + b) % _MERSENNE_PRIME) & _MAX_HASH for h in hashed)
+        for a, b in _PERMUTATIONS
+    )
+
+
+def estimate_similarity(signature_a: tuple, signature_b: tuple) -> float:
+    """MinHash署名の一致率から、2つのテキストのJaccard類似度を推定する。"""
+    return sum(1 for x, y in zip(signature_a, signature_b) if x == y) / len(signature_a)
+
+
+def _edit_distance(a: str, b: str) -> int:
+    """2つの文字列のレーベンシュタイン距離を返す。"""
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+
+def differs_only_by_ocr_noise(matched_source: str, new_source: str) -> bool:
+    """
+    2つの原文の違いが、数値・記号・大文字小文字と、単語内の数文字の読み取り揺れだけかを判定する。
+    単語の追加・削除 (否定語など) は揺れとみなさない。単語の分割・結合 ("re ceipt" と "receipt") は、
+    結合した文字列の編集距離で判定する。
+    """
+    # 数値は post_edit_translation で扱うため、桁数に関係なく同じトークンにそろえてから比較する
+    old_words = normalize_source_text(_NUMBER_PATTERN.sub("0", matched_source)).split()
+    new_words = normalize_source_text(_NUMBER_PATTERN.sub("0", new_source)).split()
+    for tag, i1, i2, j1, j2 in SequenceMatcher(None, old_words, new_words, autojunk=False).get_opcodes():
+        if tag == "equal":
+            continue
+        if tag != "replace":
+            return False
+        old_part, new_part = "".join(old_words[i1:i2]), "".join(new_words[j1:j2])
+        allowed_edits = max(1, max(len(old_part), len(new_part)) // OCR_NOISE_CHARS_PER_EDIT)
+        if _edit_distance(old_part, new_part) > allowed_edits:
+            return False
+    return True
+
+
+def _number_span_pattern(number: str):
+    """数値トークン全体に一致する正規表現 ("10" が "100" や "1.10" の一部に一致しないように前後の数字を除外)。"""
+    return re.compile(r"(?<!\d)(?<!\d[.,])" + re.escape(number) + r"(?![.,]?\d)")
+
+
+def post_edit_translation(matched_source: str, new_source: str, translated_text: str) -> tuple:
+    """
+    再利用する訳文のうち、原文で数値だけが異なる箇所 (価格・数量など) を新しい原文の値に置き換える。
+
+    Args:
+        matched_source (str): 翻訳メモリーに登録されている原文。
+        new_source (str): 翻訳したい原文。
+        translated_text (str): matched_source の訳文。
+
+    Returns:
+        tuple: (置き換え後の訳文, 原文の数値の違いをすべて置き換えられたか)。
+               数値の個数が異なる場合や、同じ数値が別々の値に変わった場合、
+               訳文中の出現回数が原文と一致しない場合は置き換えられないとみなす。
+    """
+    old_numbers = _NUMBER_PATTERN.findall(matched_source)
+    new_numbers = _NUMBER_PATTERN.findall(new_source)
+    if old_numbers == new_numbers:
+        return translated_text, True
+    if len(old_numbers) != len(new_numbers):
+        return translated_text, False
+
+    # 変更された数値ごとに置き換え先を決める (同じ数値が複数の値に変わった場合は訳文の位置を特定できない)
+    replacements = {}
+    for old_number, new_number in zip(old_numbers, new_numbers):
+        if old_number != new_number:
+            replacements.setdefault(old_number, set()).add(new_number)
+    spans = []
+    for old_number, candidates in replacements.items():
+        matches = list(_number_span_pattern(old_number).finditer(translated_text))
+        if len(candidates) != 1 or not matches or len(matches) != old_numbers.count(old_number):
+            return translated_text, False
+        new_number = next(iter(candidates))
+        spans.extend((match.start(), match.end(), new_number) for match in matches)
+
+    # 置き換えは元の訳文上の位置で一度に行う (置き換えた値が別の数値の置き換え対象にならないように)
+    edited, position = [], 0
+    for span_start, span_end, new_number in sorted(spans):
+        edited.append(translated_text[position:span_start])
+        edited.append(new_number)
+        position = span_end
+    edited.append(translated_text[position:])
+    return "".join(edited), True
+
+
+class TranslationMemory:
+    """
+    原文のMinHash署名とLSHバケットで過去の翻訳を検索するローカルインデックス。
+    Streamlitでは複数セッションから同時に使われるため、インデックスと統計はロックで保護する。
+    エントリーは追加順に保持し、max_entries を超えたら最も古いものから削除する。
+    """
+
+    def __init__(self, threshold: float = None, post_edit: bool = None, max_entries: int = None):
+        self.threshold = threshold if threshold is not None else float(
+            os.getenv("TRANSLATION_MEMORY_THRESHOLD", str(DEFAULT_SIMILARITY_THRESHOLD)))
+        self.post_edit = post_edit if post_edit is not None else (
+            os.getenv("TRANSLATION_MEMORY_POST_EDIT", "true").lower() in ("1", "true", "yes"))
+        self.max_entries = max_entries if max_entries is not None else int(os.getenv("TRANSLATION_MEMORY_MAX_ENTRIES", "5000"))
+        self._lock = threading.Lock()
+        self._entries = {} # id -> {"tenantId", "originalText", "translatedText", "signature"} (追加順)
+        self._buckets = {} # (テナントキー, バンド番号, バンドの値) -> 該当エントリーのidの集合
+        self._stats = {"lookups": 0, "hits": 0, "postEdits": 0, "numberMismatches": 0, "wordMismatches": 0, "charactersSaved": 0, "lookupTimeMs": 0.0}
+
+    def _band_keys(self, tenant_id: str, signature: tuple) -> list:
+        rows = len(signature) // NUM_BANDS
+        return [(tenant_id, band, signature[band * rows:(band + 1) * rows]) for band in range(NUM_BANDS)]
+
+    def _evict_oldest(self):
+        """最も古く追加されたエントリーを、LSHバケットからも削除する (ロック取得済みで呼び出す)。"""
+        oldest_id = next(iter(self._entries))
+        oldest_entry = self._entries.pop(oldest_id)
+        for band_key in self._band_keys(oldest_entry["tenantId"], oldest_entry["signature"]):
+            bucket = self._buckets.get(band_key)
+            if bucket is not None:
+                bucket.discard(oldest_id)
+                if not bucket:
+                    del self._buckets[band_key]
+
+    def add(self, entry_id: str, original_text: str, translated_text: str, tenant_id: str = None):
+        """原文と訳文の組をインデックスに追加する。上限件数に達している場合は最も古いエントリーを削除する。"""
+        normalized = normalize_source_text(original_text or "")
+        if not normalized or not translated_text or self.max_entries <= 0:
+            return
+        tenant_id = tenant_id or get_default_tenant_id()
+        signature = minhash_signature(normalized)
+        with self._lock:
+            if entry_id in self._entries:
+                return
+            while len(self._entries) >= self.max_entries:
+                self._evict_oldest()
+            self._entries[entry_id] = {
+                "tenantId": tenant_id,
+                "originalText": original_text,
+                "translatedText": translated_text,
+                "signature": signature,
+            }
+            for band_key in self._band_keys(tenant_id, signature):
+                self._buckets.setdefault(band_key, set()).add(entry_id)
+
+    def load_from_cosmos(self, container) -> int:
+        """
+        Cosmos DBに保存済みの翻訳から、原文と訳文を読み込んでインデックスを構築する。
+
+        Args:
+            container: Cosmos DBのコンテナーオブジェクト。
+
+        Returns:
+            int: 読み込んだ件数。
+        """
+        items = profile_cosmos_query(
+            container,
+            "SELECT TOP @max_entries c.id, c.tenantId, c.originalText, c.translatedText FROM c "
+            "WHERE IS_STRING(c.originalText) AND IS_STRING(c.translatedText) AND c.translatedText != '' "
+            "ORDER BY c._ts DESC",
+            [{"name": "@max_entries", "value": self.max_entries}],
+            query_shape="translation_memory_load",
+            search_mode="load",
+            top_k=self.max_entries,
+            enable_cross_partition_query=True
+        )
+        # 新しい順に取得しているため、古い順に追加する (上限を超えたときに古いものから削除されるように)
+        for item in reversed(items):
+            self.add(item["id"], item["originalText"], item["translatedText"], tenant_id=item.get("tenantId"))
+        print(f"Translation memory loaded {len(items)} entries.")
+        return len(items)
+
+    def lookup(self, original_text: str, tenant_id: str = None):
+        """
+        類似度がしきい値以上の過去の翻訳を探す。
+
+        Args:
+            original_text (str): 翻訳したい原文。
+            tenant_id (str): 呼び出し元のテナント/ユーザーキー。このテナント (と設定に応じて既定のテナント) の訳文だけを再利用する。
+
+        Returns:
+            dict: 見つかった場合は {"id", "translatedText", "similarity", "postEdited"}。
+                  見つからない場合や、原文の違いが読み取り揺れを超える場合、
+                  原文の数値の違いを訳文で置き換えられない場合はNone。
+        """
+        started = time.perf_counter()
+        normalized = normalize_source_text(original_text or "")
+        match = None
+        rejection = None # 類似した原文が見つかったが再利用しなかった理由 (統計のキー)
+        if normalized:
+            signature = minhash_signature(normalized)
+            tenant_ids = get_searchable_tenant_ids(tenant_id or get_default_tenant_id())
+            with self._lock:
+                candidate_ids = set()
+                for searchable_tenant_id in tenant_ids:
+                    for band_key in self._band_keys(searchable_tenant_id, signature):
+                        candidate_ids.update(self._buckets.get(band_key, ()))
+                best_id, best_similarity = None, 0.0
+                for candidate_id in candidate_ids:
+                    similarity = estimate_similarity(signature, self._entries[candidate_id]["signature"])
+                    if similarity > best_similarity:
+                        best_id, best_similarity = candidate_id, similarity
+                best_entry = self._entries.get(best_id) if best_similarity >= self.threshold else None
+
+            if best_entry and not differs_only_by_ocr_noise(best_entry["originalText"], original_text):
+                rejection = "wordMismatches"
+            elif best_entry:
+                translated_text = best_entry["translatedText"]
+                if self.post_edit:
+                    translated_text, numbers_resolved = post_edit_translation(best_entry["originalText"], original_text, translated_text)
+                else:
+                    numbers_resolved = _NUMBER_PATTERN.findall(best_entry["originalText"]) == _NUMBER_PATTERN.findall(original_text)
+                # 正規化では数字を0に置き換えるため、価格などが異なる原文も類似度1.0になる。古い数値の訳文は再利用しない
+                if numbers_resolved:
+                    match = {
+                        "id": best_id,
+                        "translatedText": translated_text,
+                        "similarity": best_similarity,
+                        "postEdited": translated_text != best_entry["translatedText"],
+                    }
+                else:
+                    rejection = "numberMismatches"
+
+        with self._lock:
+            self._stats["lookups"] += 1
+            self._stats["lookupTimeMs"] += (time.perf_counter() - started) * 1000
+            if rejection:
+                self._stats[rejection] += 1
+            if match:
+                self._stats["hits"] += 1
+                self._stats["charactersSaved"] += len(original_text)
+                self._stats["postEdits"] += 1 if match["postEdited"] else 0
+        return match
+
+    def stats(self) -> dict:
+        """再利用率、節約できたTranslatorの文字数、検索時間などの統計を返す。"""
+        with self._lock:
+            lookups = self._stats["lookups"]
+            return {
+                "entries": len(self._entries),
+                "lookups": lookups,
+                "hits": self._stats["hits"],
+                "reuseRate": round(self._stats["hits"] / lookups, 3) if lookups else 0.0,
+                "postEdits": self._stats["postEdits"],
+                "numberMismatches": self._stats["numberMismatches"],
+                "wordMismatches": self._stats["wordMismatches"],
+                "translatorCharactersSaved": self._stats["charactersSaved"],
+                "avgLookupTimeMs": round(self._stats["lookupTimeMs"] / lookups, 2) if lookups else 0.0,
+            }
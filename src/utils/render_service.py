@@ -0,0 +1,243 @@
+import atexit
+import io
+import multiprocessing
+import os
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from PIL import Image
+
+from utils.image_utils import embed_text_on_image
+
+# このファイルでは、embed_text_on_image (デコード・RGBA変換・描画・PNGエンコード) を
+# プロセスプールで実行するレンダリングサービスを実装します。
+# - 画像データは共有メモリで受け渡し、pickleによるバイト列のコピーを避ける
+# - 同時に受け付けるタスク数を制限し、上限に達したら空きが出るまで呼び出し側を待たせる (バックプレッシャー)
+#   ワーカー数を超えるタスクはプールのキューではなく呼び出し側で待たせ、プールに渡したタスクはすぐに実行されるようにする
+# - タスクごとにタイムアウトを設定。時間はワーカーが描画を開始した時点から計る
+#   (タイムアウトしたタスクはワーカーを強制終了して止め、プールを作り直す)
+# - 小さな画像はプロセス間の受け渡しのほうが高くつくため、呼び出し元のスレッドで描画する
+
+
+# 入力の共有メモリの先頭に置く、ワーカーが描画を開始した時刻 (UNIX時間のdouble。0は未開始)
+_STARTED_AT_FORMAT = "d"
+_STARTED_AT_SIZE = struct.calcsize(_STARTED_AT_FORMAT)
+
+
+def _render_in_worker(input_name: str, input_size: int, text_to_embed: str) -> tuple:
+    """
+    ワーカープロセスで実行する描画処理。共有メモリから画像を読み、結果のPNGを新しい共有メモリに書き込む。
+    開始時刻を共有メモリの先頭に書き込み、呼び出し側がキューでの待ち時間を除いてタイムアウトを判定できるようにする。
+
+    Returns:
+        tuple: (結果を書き込んだ共有メモリ名, バイト数)
+    """
+    input_memory = shared_memory.SharedMemory(name=input_name)
+    try:
+        struct.pack_into(_STARTED_AT_FORMAT, input_memory.buf, 0, time.time())
+        image_bytes = bytes(input_memory.buf[_STARTED_AT_SIZE:_STARTED_AT_SIZE + input_size])
+    finally:
+        input_memory.close()
+
+    output_bytes = embed_text_on_image(image_bytes, text_to_embed)
+
+    output_memory = shared_memory.SharedMemory(create=True, size=max(len(output_bytes), 1))
+    output_memory.buf[:len(output_bytes)] = output_bytes
+    output_memory.close() # 解放 (unlink) は結果を受け取った親プロセスが行う
+    return output_memory.name, len(output_bytes)
+
+
+def _read_and_release_output(output_name: str, output_size: int) -> bytes:
+    """ワーカーが書き込んだ共有メモリから結果を読み出し、共有メモリを解放する。"""
+    output_memory = shared_memory.SharedMemory(name=output_name)
+    try:
+        return bytes(output_memory.buf[:output_size])
+    finally:
+        output_memory.close()
+        output_memory.unlink()
+
+
+def _release_late_output(future):
+    """タイムアウト後に完了したタスクの結果 (共有メモリ) を解放する。"""
+    if not future.cancelled() and future.exception() is None:
+        output_name, _ = future.result()
+        try:
+            memory = shared_memory.SharedMemory(name=output_name)
+            memory.close()
+            memory.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class RenderService:
+    """
+    画像へのテキスト埋め込みをプロセスプールで実行するサービス。
+    Streamlitの複数セッションやバッチ処理から同時に呼ばれることを想定し、スレッドセーフに動作する。
+    """
+
+    def __init__(
+        self,
+        max_workers: int = None,
+        max_pending: int = None,
+        task_timeout: float = None,
+        inline_max_pixels: int = None
+    ):
+        # 0 を明示的に指定できるよう (max_workers=0 は常に呼び出し元のスレッドで描画)、未指定 (None) の場合のみ環境変数を使う
+        self.max_workers = max_workers if max_workers is not None else int(
+            os.getenv("RENDER_MAX_WORKERS", str(os.cpu_count() or 1)))
+        self.max_pending = max_pending if max_pending is not None else int(
+            os.getenv("RENDER_MAX_PENDING", str(max(self.max_workers, 1) * 2)))
+        self.task_timeout = task_timeout if task_timeout is not None else float(os.getenv("RENDER_TASK_TIMEOUT", "30"))
+        self.inline_max_pixels = inline_max_pixels if inline_max_pixels is not None else int(
+            os.getenv("RENDER_INLINE_MAX_PIXELS", str(512 * 512)))
+        self._slots = threading.BoundedSemaphore(max(self.max_pending, 1)) # 0 では受け付けられないため最低1
+        self._running = threading.BoundedSemaphore(max(self.max_workers, 1)) # プールに渡すタスク数 (ワーカー数まで)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                # Streamlitはスレッドを使うため、forkではなくspawnでワーカーを起動する
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._executor
+
+    def _reset_executor(self):
+        """ワーカーが異常終了した場合にプールを作り直す。"""
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def _terminate_executor(self, executor: ProcessPoolExecutor):
+        """
+        タイムアウトしたタスクを止めるため、ワーカープロセスを強制終了してプールを作り直す。
+        実行中のタスクは future.cancel() では止まらず、ワーカーを占有し続けるため。
+        同じプールで処理中だった他のタスクは BrokenProcessPool となり、呼び出し元のスレッドで描画し直される。
+        """
+        with self._executor_lock:
+            if self._executor is executor:
+                self._executor = None # 次のタスクは新しいプールで実行する
+        if sys.version_info >= (3, 14):
+            executor.terminate_workers()
+            return
+        # Python 3.13以前のProcessPoolExecutorには実行中のワーカーを止める公開APIがないため、
+        # 内部のプロセス一覧 (_processes) からワーカーを強制終了する
+        for process in list((executor._processes or {}).values()):
+            process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _is_small_image(self, image_bytes: bytes) -> bool:
+        """画像サイズ (ヘッダーのみ読み込み) が、呼び出し元のスレッドで描画する閾値以下かを判定する。"""
+        try:
+            with Image.open(io.BytesIO(image_bytes)) as image:
+                return image.width * image.height <= self.inline_max_pixels
+        except Exception:
+            return True # 判定できない画像は embed_text_on_image にそのまま任せる
+
+    def render(self, image_bytes: bytes, text_to_embed: str) -> bytes:
+        """
+        画像にテキストを埋め込む (embed_text_on_image と同じ入出力)。
+
+        Args:
+            image_bytes (bytes): 元の画像のバイトデータ。
+            text_to_embed (str): 埋め込むテキスト。
+
+        Returns:
+            bytes: テキストが埋め込まれた画像のバイトデータ (PNG形式)。
+
+        Raises:
+            TimeoutError: 受け付け待ち、または描画がタイムアウトした場合。
+        """
+        if self.max_workers <= 0 or self._is_small_image(image_bytes):
+            return embed_text_on_image(image_bytes, text_to_embed)
+
+        # バックプレッシャー: 処理中のタスクが上限に達している場合は空きが出るまで待つ
+        if not self._slots.acquire(timeout=self.task_timeout):
+            raise TimeoutError(f"レンダリングの受け付け待ちが {self.task_timeout} 秒を超えました。")
+        input_memory = None
+        try:
+            input_memory = shared_memory.SharedMemory(create=True, size=_STARTED_AT_SIZE + len(image_bytes))
+            struct.pack_into(_STARTED_AT_FORMAT, input_memory.buf, 0, 0.0)
+            input_memory.buf[_STARTED_AT_SIZE:_STARTED_AT_SIZE + len(image_bytes)] = image_bytes
+            # 実行中のタスクがワーカー数に達している場合は、プールのキューに積まずにここで待つ
+            # (実行中のタスクはタイムアウトで必ず終わるため、待ち時間に上限は設けない)
+            with self._running:
+                try:
+                    executor = self._get_executor()
+                    future = executor.submit(_render_in_worker, input_memory.name, len(image_bytes), text_to_embed)
+                    output_name, output_size = self._wait_for_result(executor, future, input_memory)
+                except BrokenProcessPool as e:
+                    print(f"Render worker pool is broken, rendering in-thread: {e}")
+                    self._reset_executor()
+                    return embed_text_on_image(image_bytes, text_to_embed)
+            return _read_and_release_output(output_name, output_size)
+        finally:
+            if input_memory is not None:
+                input_memory.close()
+                input_memory.unlink()
+            self._slots.release()
+
+    def _wait_for_result(self, executor: ProcessPoolExecutor, future, input_memory) -> tuple:
+        """
+        ワーカーの結果を待つ。タイムアウトはワーカーが描画を開始した時刻 (共有メモリの先頭) から計る。
+
+        Raises:
+            TimeoutError: 描画の開始待ち、または描画がタイムアウトした場合。
+        """
+        submitted_at = time.time()
+        while True:
+            started_at = struct.unpack_from(_STARTED_AT_FORMAT, input_memory.buf, 0)[0]
+            if started_at:
+                remaining = started_at + self.task_timeout - time.time()
+            else:
+                # 開始前 (ワーカーの起動中など) は短い間隔で開始を確認する
+                remaining = min(submitted_at + self.task_timeout - time.time(), 0.05)
+            try:
+                return future.result(timeout=max(remaining, 0))
+            except FutureTimeoutError:
+                pass
+            if not started_at:
+                if time.time() - submitted_at <= self.task_timeout:
+                    continue
+                if future.cancel(): # まだワーカーに渡っていなければ、プールを止めずに取り消せる
+                    raise TimeoutError(f"レンダリングの開始待ちが {self.task_timeout} 秒を超えました。")
+                continue # 取り消せない場合は開始済みのため、開始時刻から計り直す
+            future.add_done_callback(_release_late_output) # 強制終了の直前に完了していた場合の結果を解放
+            print(f"Render task timed out after {self.task_timeout} seconds; terminating render workers.")
+            self._terminate_executor(executor)
+            raise TimeoutError(f"レンダリングが {self.task_timeout} 秒以内に完了しませんでした。")
+
+    def shutdown(self):
+        """プロセスプールを停止する。"""
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True, cancel_futures=True)
+                self._executor = None
+
+
+# アプリ全体で共有するレンダリングサービス (最初の利用時に作成)
+_default_render_service = None
+_default_render_service_lock = threading.Lock()
+
+
+def get_render_service() -> RenderService:
+    """アプリ全体で共有するレンダリングサービスを返す。"""
+    global _default_render_service
+    with _default_render_service_lock:
+        if _default_render_service is None:
+            _default_render_service = RenderService()
+            atexit.register(_default_render_service.shutdown)
+        return _default_render_service
+
+
+def render_text_on_image(image_bytes: bytes, text_to_embed: str) -> bytes:
+    """共有のレンダリングサービスで画像にテキストを埋め込む。"""
+    return get_render_service().render(image_bytes, text_to_embed)
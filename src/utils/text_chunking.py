@@ -0,0 +1,66 @@
+import re
+
+# OCRのブロック (段落) 単位を保ったまま、翻訳・埋め込みに渡すチャンクを作成する。
+# Translatorの1リクエストあたりの文字数上限や、埋め込みモデルのトークン上限を超えないようにするために使用。
+
+DEFAULT_CHUNK_MAX_CHARS = 1000
+
+# 文の区切り (英語の終止符・感嘆符・疑問符の後の空白)
+_SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+")
+
+
+def _split_long_text(text: str, max_chars: int) -> list:
+    """max_charsを超えるテキストを文単位で分割する。1文が長すぎる場合は空白で分割する。"""
+    pieces = []
+    current = ""
+    for sentence in _SENTENCE_BOUNDARY.split(text):
+        while len(sentence) > max_chars:
+            # 1文が上限を超える場合は、上限内の最後の空白で切る (空白がなければ上限位置で切る)
+            cut = sentence.rfind(" ", 0, max_chars)
+            cut = cut if cut > 0 else max_chars
+            if current:
+                pieces.append(current)
+                current = ""
+            pieces.append(sentence[:cut].strip())
+            sentence = sentence[cut:].strip()
+        if current and len(current) + 1 + len(sentence) > max_chars:
+            pieces.append(current)
+            current = sentence
+        else:
+            current = f"{current} {sentence}".strip()
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def chunk_ocr_blocks(blocks: list, max_chars: int = DEFAULT_CHUNK_MAX_CHARS) -> list:
+    """
+    OCRのブロックテキストを、max_chars以下のチャンクにまとめる。
+
+    Args:
+        blocks (list): OCRのブロックごとのテキスト (get_ocr_blocks の戻り値)。
+        max_chars (int): 1チャンクあたりの最大文字数。
+
+    Returns:
+        list: チャンクのテキストリスト。短いブロックは隣接ブロックとまとめ、長いブロックは文単位で分割する。
+    """
+    chunks = []
+    current = ""
+    for block in blocks:
+        block = block.strip()
+        if not block:
+            continue
+        if len(block) > max_chars:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.extend(_split_long_text(block, max_chars))
+            continue
+        if current and len(current) + 1 + len(block) > max_chars:
+            chunks.append(current)
+            current = block
+        else:
+            current = f"{current}\n{block}" if current else block
+    if current:
+        chunks.append(current)
+    return chunks
@@ -0,0 +1,51 @@
+import array
+import base64
+import math
+
+# チャンクごとの埋め込みベクトルを扱うためのユーティリティ
+
+
+def normalize_vector(vector: list) -> list:
+    """ベクトルを長さ1に正規化する。"""
+    norm = math.sqrt(sum(value * value for value in vector))
+    return [value / norm for value in vector] if norm else list(vector)
+
+
+def mean_vector(vectors: list) -> list:
+    """複数のベクトルの平均を正規化して返す (ドキュメント全体を表す代表ベクトル)。"""
+    if len(vectors) == 1:
+        return list(vectors[0])
+    mean = [sum(values) / len(vectors) for values in zip(*vectors)]
+    return normalize_vector(mean)
+
+
+def cosine_similarity(a: list, b: list) -> float:
+    """2つのベクトルのコサイン類似度を返す。"""
+    dot = sum(x * y for x, y in zip(a, b))
+    norm_a = math.sqrt(sum(x * x for x in a))
+    norm_b = math.sqrt(sum(y * y for y in b))
+    return dot / (norm_a * norm_b) if norm_a and norm_b else 0.0
+
+
+def quantize_vector(vector: list) -> dict:
+    """
+    保存サイズを抑えるため、ベクトルをint8にスカラー量子化し、base64文字列として返す。
+
+    Args:
+        vector (list): 量子化するベクトル。
+
+    Returns:
+        dict: {"scale": 要素の最大絶対値/127, "int8": int8配列のbase64文字列}
+    """
+    max_abs = max((abs(value) for value in vector), default=0.0)
+    scale = max_abs / 127 if max_abs else 1.0
+    quantized = array.array("b", (max(-127, min(127, round(value / scale))) for value in vector))
+    return {"scale": scale, "int8": base64.b64encode(quantized.tobytes()).decode("ascii")}
+
+
+def dequantize_vector(stored) -> list:
+    """quantize_vector で保存したベクトルを復元する。floatのリストで保存された (以前の形式の) ベクトルはそのまま返す。"""
+    if isinstance(stored, dict):
+        quantized = array.array("b", base64.b64decode(stored["int8"]))
+        return [value * stored["scale"] for value in quantized]
+    return list(stored)